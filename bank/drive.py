@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 """Main handler for program actions"""
 # dependencies ----------------------------------------------------------------------
-from . import state
+from pathlib import Path
+from urllib.parse import quote
+from . import state, stats
+
+
+# constants -------------------------------------------------------------------------
+IMPORT_BATCH_SIZE = 100000
 
 
 # module variables  -----------------------------------------------------------------
@@ -9,41 +15,169 @@ ledger = None
 
 
 # actions  -------------------------------------------------------------------------
+@stats.timed('drive.state_refresh')
 def state_refresh(state_override={}):
     global ledger
     ledger = state.load(state_override=state_override)
     state.save(ledger)    
 
 
+@stats.timed('drive.state_flush')
+def state_flush():
+    """write mutations queued by a deferred SAVE_POLICY"""
+    state.flush()
+
+
+@stats.timed('drive.transaction_add')
 def transaction_add(date: str, account: str, t_type: str, amount: float):
     try:
         txn = ledger.add_transaction(date, account, t_type, float(amount))
     except Exception as e:
         return {'success': -1, 'error': str(e)}
     else:
-        state.save(ledger)
+        state.save(ledger, record={'op': 'T', 'date': date, 'account': account, 'type': t_type, 'amount': float(amount)})
         return {'success': 1, 'txn_id': txn.txn_id}
 
 
+@stats.timed('drive.transactions_import')
+def transactions_import(rows, batch_size: int = IMPORT_BATCH_SIZE):
+    """stream [date, account, type, amount] rows into the ledger, saving once per batch"""
+    imported = 0
+    errors = []
+    batch = []
+
+    def _flush():
+        nonlocal imported
+        count, batch_errors = ledger.import_transactions(batch)
+        imported += count
+        errors.extend(batch_errors)
+        state.save(ledger)
+        batch.clear()
+
+    try:
+        for row_no, fields in enumerate(rows, 1):
+            batch.append((row_no, list(fields)))
+            if len(batch) >= batch_size:
+                _flush()
+        if batch:
+            _flush()
+    except Exception as e:
+        return {'success': -1, 'error': str(e), 'imported': imported, 'errors': errors}
+    return {'success': 1, 'imported': imported, 'errors': errors}
+
+
+@stats.timed('drive.rule_add')
 def rule_add(date: str, rule_id: str, rate: float):
     try:
         ledger.add_rule(date, rule_id, float(rate))
     except Exception as e:
         return {'success': -1, 'error': str(e)}
     else:
-        state.save(ledger)
+        state.save(ledger, record={'op': 'R', 'date': date, 'rule_id': rule_id, 'rate': float(rate)})
         return {'success': 1}
 
 
-def statement(account: str, year_month: str):
+@stats.timed('drive.statement')
+def statement(account: str, year_month: str, as_of=None):
+    """statement for the month, as of an earlier mutation seq or time when given"""
     try:
-        result = ledger.statement(account, year_month)
+        if as_of is not None:
+            # rebuilt from history on a separate ledger, nothing to save
+            return {'success': 1, **ledger.statement(account, year_month, as_of=as_of)}
+        if ledger.is_archived(account, year_month):
+            return {'success': 1, **ledger.archived_statement(account, year_month, state.archive_rows(account))}
+        result, cached = ledger.statement_cached(account, year_month)
     except Exception as e:
         return {'success': -1, 'error': str(e)}
     else:
-        state.save(ledger)
+        if cached:
+            # nothing changed since it was rendered, so there is nothing to save
+            return {'success': 1, **result}
+        state.save(ledger, record={'op': 'S', 'account': account, 'year_month': year_month})
         return {'success': 1, **result}
 
 
+@stats.timed('drive.statement_range')
+def statement_range(account: str, from_year_month: str, to_year_month: str, out_path: str = None):
+    """statements for a range of months, streamed to out_path line by line when given"""
+    try:
+        lines = ledger.statement_range(account, from_year_month, to_year_month)
+        if out_path is None:
+            result = {'statement': '\n'.join(lines)}
+        else:
+            count = 0
+            with open(out_path, 'w') as f:
+                for line in lines:
+                    f.write(line + '\n')
+                    count += 1
+            result = {'lines': count}
+    except Exception as e:
+        return {'success': -1, 'error': str(e)}
+    else:
+        state.save(ledger, record={'op': 'S', 'account': account, 'year_month': to_year_month})
+        return {'success': 1, **result}
+
+
+@stats.timed('drive.balance_as_of')
+def balance_as_of(account: str, date: str, as_of=None):
+    try:
+        balance = ledger.balance_as_of(account, date, as_of=as_of)
+    except Exception as e:
+        return {'success': -1, 'error': str(e)}
+    return {'success': 1, 'balance': balance}
+
+
+@stats.timed('drive.close_month')
+def close_month(year_month: str):
+    try:
+        result = ledger.close_month(year_month)
+    except Exception as e:
+        return {'success': -1, 'error': str(e)}
+    else:
+        state.save(ledger, record={'op': 'C', 'year_month': year_month})
+        return {'success': 1, **result}
+
+
+@stats.timed('drive.simulate_rules')
+def simulate_rules(schedules: dict, from_year_month: str, to_year_month: str):
+    """what-if interest per rule schedule, the ledger is not changed so nothing is saved"""
+    try:
+        scenarios = ledger.simulate_rules(schedules, from_year_month, to_year_month)
+    except Exception as e:
+        return {'success': -1, 'error': str(e)}
+    return {'success': 1, 'scenarios': scenarios}
+
+
+@stats.timed('drive.archive')
+def archive(year_month: str):
+    """fold months up to year_month into checkpoints, moving their rows to the cold archive"""
+    try:
+        archived = ledger.archive(year_month)
+        # archive first: after a crash before the save the rows are still in the ledger
+        state.archive_append(archived)
+    except Exception as e:
+        return {'success': -1, 'error': str(e)}
+    else:
+        state.save(ledger)
+        return {'success': 1, 'accounts': len(archived), 'archived': sum(len(rows) for rows in archived.values())}
+
+
+@stats.timed('drive.statements_for_month')
+def statements_for_month(year_month: str, workers: int = 1, out_dir: str = None):
+    """statements for all accounts, optionally written to one file per account"""
+    try:
+        statements = ledger.statements_for_month(year_month, workers=int(workers))
+        if out_dir is not None:
+            Path(out_dir).mkdir(parents=True, exist_ok=True)
+            for name, result in statements.items():
+                path = Path(out_dir) / f"{quote(name, safe='')}_{year_month}.txt"
+                path.write_text(result['statement'] + '\n')
+    except Exception as e:
+        return {'success': -1, 'error': str(e)}
+    else:
+        state.save(ledger, record={'op': 'C', 'year_month': year_month})
+        return {'success': 1, 'statements': statements}
+
+
 # main  -------------------------------------------------------------------------------
 ledger = state.load()
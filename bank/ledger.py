@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 """Classes for the transaction data model"""
 # dependencies ----------------------------------------------------------------------
+import bisect
 import datetime as dt
+import heapq
+import operator
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass, field
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Set
+from . import stats
 
 # constants ------------------------------------------------------------------------------
 TXN_DATE_FORMAT = '%Y%m%d'
 MAX_YEARMONTH = 209912
+INTEREST_SEQ = 0x7FFF  # columnar sequence of the '-I' txn id, sorts after same-day rows
+CHECKPOINT_SEQ = 0  # columnar sequence of the '-B' carry-forward txn id
+STATEMENT_CACHE_SIZE = 1024  # rendered statements kept per ledger
 
 
 # helper functions -----------------------------------------------------------------------
@@ -19,7 +34,54 @@ def end_of_month(year, month):
     return end_date
 
 
+@lru_cache(maxsize=None)
+def parse_date(date_str: str) -> dt.date:
+    """persisted YYYYMMDD date, cached as stored rows repeat the same days"""
+    return dt.datetime.strptime(date_str, TXN_DATE_FORMAT).date()
+
+
 # classes ------------------------------------------------------------------------------
+class RWLock:
+    """readers-writer lock, waiting writers take priority over new readers
+
+    not reentrant: a thread holding the lock must not acquire it again
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
 @dataclass
 class Transaction:
     date: dt.date
@@ -40,34 +102,433 @@ class Account:
     name: str
     transactions: List[Transaction] = field(default_factory=list)
 
-    def add_transaction(self, txn: Transaction) -> None:
-        self.transactions.append(txn)
+    def __post_init__(self):
+        # sorted index: _dates mirrors transactions, _balances[i] is the running
+        # balance after the first i transactions, _by_date groups same-day rows
         self.transactions.sort(key=lambda t: (t.date, t.txn_id))
+        self._reindex()
+        # bumped on every mutation, used by storage to write only changed accounts
+        self.version = 0
+
+    # --- index ---
+    @staticmethod
+    def _signed_amount(t: Transaction) -> float:
+        t_type = t.type.upper()
+        if t_type in ('D', 'I', 'B'):
+            return t.amount
+        elif t_type == 'W':
+            return -t.amount
+        return 0.0
+
+    def _reindex(self, start: int = 0) -> None:
+        if start == 0:
+            self._keys = []
+            self._dates = []
+            self._balances = [0.0]
+            self._by_date: Dict[dt.date, List[Transaction]] = {}
+            for t in self.transactions:
+                self._by_date.setdefault(t.date, []).append(t)
+        else:
+            del self._keys[start:]
+            del self._dates[start:]
+            del self._balances[start + 1:]
+        bal = self._balances[start]
+        for t in self.transactions[start:]:
+            self._keys.append((t.date, t.txn_id))
+            self._dates.append(t.date)
+            bal += self._signed_amount(t)
+            self._balances.append(bal)
+
+    def add_transaction(self, txn: Transaction) -> None:
+        self.version += 1
+        key = (txn.date, txn.txn_id)
+        i = bisect.bisect_right(self._keys, key)
+        self.transactions.insert(i, txn)
+        bisect.insort(self._by_date.setdefault(txn.date, []), txn, key=lambda t: t.txn_id)
+        if i == len(self._keys):
+            # chronological append, extend the index in O(1)
+            self._keys.append(key)
+            self._dates.append(txn.date)
+            self._balances.append(self._balances[-1] + self._signed_amount(txn))
+        else:
+            self._reindex(i)
+
+    def remove_interest_from(self, date: dt.date) -> List[Transaction]:
+        """drop posted interest rows dated on or after date, returning them"""
+        i = bisect.bisect_left(self._dates, date)
+        removed = [t for t in self.transactions[i:] if t.type == 'I']
+        if not removed:
+            return removed
+        self.version += 1
+        self.transactions[i:] = [t for t in self.transactions[i:] if t.type != 'I']
+        for t in removed:
+            day_txns = self._by_date[t.date]
+            day_txns.remove(t)
+            if not day_txns:
+                del self._by_date[t.date]
+        self._reindex(i)
+        return removed
+
+    def checkpoint(self, date: dt.date) -> List[Transaction]:
+        """fold rows dated on or before date into one 'B' carry-forward row, returning the folded rows"""
+        i = bisect.bisect_right(self._dates, date)
+        folded = [t for t in self.transactions[:i] if t.type != 'B']
+        if not folded:
+            return folded
+        self.version += 1
+        carry = Transaction(
+            date=date, txn_id=f"{date.strftime(TXN_DATE_FORMAT)}-B", type='B', amount=round(self._balances[i], 2)
+        )
+        self.transactions[:i] = [carry]
+        self._reindex()
+        return folded
 
+    # --- lookups ---
     def balance_before(self, date: dt.date) -> float:
-        bal = 0.0
-        for t in sorted(self.transactions, key=lambda t: (t.date, t.txn_id)):
-            if t.date >= date:
-                break
-            if t.type.upper() == 'D':
-                bal += t.amount
-            elif t.type.upper() == 'W':
-                bal -= t.amount
-            elif t.type.upper() == 'I':
-                bal += t.amount
-        return bal
+        return self._balances[bisect.bisect_left(self._dates, date)]
+
+    def balance_through(self, date: dt.date) -> float:
+        """balance at the end of the given day, including same-day transactions"""
+        return self._balances[bisect.bisect_right(self._dates, date)]
+
+    def transactions_on(self, date: dt.date) -> List[Transaction]:
+        return self._by_date.get(date, [])
+
+    def transactions_between(self, start_date: dt.date, end_date: dt.date) -> List[Transaction]:
+        lo = bisect.bisect_left(self._dates, start_date)
+        hi = bisect.bisect_right(self._dates, end_date)
+        return self.transactions[lo:hi]
 
     def transactions_in_month(self, year: int, month: int) -> List[Transaction]:
-        return [
-            t for t in sorted(self.transactions, key=lambda t: (t.date, t.txn_id))
-            if t.date.year == year and t.date.month == month
-        ]
+        return self.transactions_between(dt.date(year, month, 1), end_of_month(year, month))
 
 
-class Ledger:
+class TransactionView:
+    """read-only Transaction API over one row of a ColumnarAccount"""
+    __slots__ = ('ordinal', 'seq', 'code', 'cents')
+
+    def __init__(self, ordinal: int, seq: int, code: int, cents: int):
+        self.ordinal = ordinal
+        self.seq = seq
+        self.code = code
+        self.cents = cents
+
+    @property
+    def date(self) -> dt.date:
+        return dt.date.fromordinal(self.ordinal)
+
+    @property
+    def type(self) -> str:
+        return chr(self.code)
+
+    @property
+    def amount(self) -> float:
+        return self.cents / 100
+
+    @property
+    def txn_id(self) -> str:
+        if self.code == 66:  # 'B'
+            suffix = 'B'
+        else:
+            suffix = 'I' if self.seq == INTEREST_SEQ else f'{self.seq:02d}'
+        return f"{self.date.strftime(TXN_DATE_FORMAT)}-{suffix}"
+
+    def __repr__(self) -> str:
+        return f'TransactionView(date={self.date!r}, txn_id={self.txn_id!r}, type={self.type!r}, amount={self.amount!r})'
+
+
+class _ColumnRows(Sequence):
+    # the transactions list of a ColumnarAccount, rows materialize as views
+    def __init__(self, acc: 'ColumnarAccount'):
+        self._acc = acc
+
+    def __len__(self) -> int:
+        return len(self._acc._ordinals)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._acc._row(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('transaction index out of range')
+        return self._acc._row(i)
+
+
+class ColumnarAccount:
+    """Account stored as typed columns with integer-cent amounts
+
+    rows are kept sorted in parallel arrays of date ordinals, txn id sequence
+    numbers, type codes and int64 cents, with an int64 prefix-sum balance
+    column; transactions are exposed through TransactionView objects. txn ids
+    must follow the ledger's YYYYMMDD-NN / YYYYMMDD-I format
+    """
+    __slots__ = ('name', 'version', '_ordinals', '_seqs', '_codes', '_cents', '_balances')
+
+    def __init__(self, name: str, transactions: List[Transaction] = None):
+        self.name = name
+        self.version = 0
+        self._ordinals = array('i')
+        self._seqs = array('h')
+        self._codes = array('B')
+        self._cents = array('q')
+        self._balances = array('q', [0])
+        for t in sorted(transactions or [], key=lambda t: (t.date, self._seq(t.txn_id))):
+            self._append(t.date.toordinal(), self._seq(t.txn_id), ord(t.type), round(t.amount * 100))
+
+    @staticmethod
+    def _seq(txn_id: str) -> int:
+        suffix = txn_id.rpartition('-')[2]
+        if suffix == 'I':
+            return INTEREST_SEQ
+        if suffix == 'B':
+            return CHECKPOINT_SEQ
+        if not suffix.isdigit():
+            raise ValueError(f'Unsupported txn id {txn_id} for columnar storage')
+        return int(suffix)
+
+    @staticmethod
+    def _signed_cents(code: int, cents: int) -> int:
+        if code in (66, 68, 73):  # 'B', 'D', 'I'
+            return cents
+        elif code == 87:  # 'W'
+            return -cents
+        return 0
+
+    def _row(self, i: int) -> TransactionView:
+        return TransactionView(self._ordinals[i], self._seqs[i], self._codes[i], self._cents[i])
+
+    def _append(self, ordinal: int, seq: int, code: int, cents: int) -> None:
+        self._ordinals.append(ordinal)
+        self._seqs.append(seq)
+        self._codes.append(code)
+        self._cents.append(cents)
+        self._balances.append(self._balances[-1] + self._signed_cents(code, cents))
+
+    def _reindex(self, start: int) -> None:
+        del self._balances[start + 1:]
+        bal = self._balances[start]
+        for code, cents in zip(self._codes[start:], self._cents[start:]):
+            bal += self._signed_cents(code, cents)
+            self._balances.append(bal)
+
+    @property
+    def transactions(self) -> _ColumnRows:
+        return _ColumnRows(self)
+
+    def add_transaction(self, txn: Transaction) -> None:
+        self.version += 1
+        ordinal = txn.date.toordinal()
+        seq = self._seq(txn.txn_id)
+        code = ord(txn.type)
+        cents = round(txn.amount * 100)
+        lo = bisect.bisect_left(self._ordinals, ordinal)
+        hi = bisect.bisect_right(self._ordinals, ordinal)
+        i = lo + bisect.bisect_right(self._seqs[lo:hi], seq)
+        if i == len(self._ordinals):
+            self._append(ordinal, seq, code, cents)
+            return
+        self._ordinals.insert(i, ordinal)
+        self._seqs.insert(i, seq)
+        self._codes.insert(i, code)
+        self._cents.insert(i, cents)
+        self._reindex(i)
+
+    def remove_interest_from(self, date: dt.date) -> List[TransactionView]:
+        start = bisect.bisect_left(self._ordinals, date.toordinal())
+        keep = [j for j in range(start, len(self._ordinals)) if self._codes[j] != 73]
+        removed = [self._row(j) for j in range(start, len(self._ordinals)) if self._codes[j] == 73]
+        if not removed:
+            return removed
+        self.version += 1
+        for column in (self._ordinals, self._seqs, self._codes, self._cents):
+            tail = [column[j] for j in keep]
+            del column[start:]
+            column.extend(tail)
+        self._reindex(start)
+        return removed
+
+    def checkpoint(self, date: dt.date) -> List[TransactionView]:
+        end = bisect.bisect_right(self._ordinals, date.toordinal())
+        folded = [self._row(j) for j in range(end) if self._codes[j] != 66]
+        if not folded:
+            return folded
+        self.version += 1
+        cents = self._balances[end]
+        for column, value in zip(
+            (self._ordinals, self._seqs, self._codes, self._cents), (date.toordinal(), CHECKPOINT_SEQ, 66, cents)
+        ):
+            del column[:end]
+            column.insert(0, value)
+        self._reindex(0)
+        return folded
+
+    # --- lookups ---
+    def balance_cents_before(self, date: dt.date) -> int:
+        return self._balances[bisect.bisect_left(self._ordinals, date.toordinal())]
+
+    def balance_cents_through(self, date: dt.date) -> int:
+        return self._balances[bisect.bisect_right(self._ordinals, date.toordinal())]
+
+    def balance_before(self, date: dt.date) -> float:
+        return self.balance_cents_before(date) / 100
+
+    def balance_through(self, date: dt.date) -> float:
+        """balance at the end of the given day, including same-day transactions"""
+        return self.balance_cents_through(date) / 100
+
+    def transactions_between(self, start_date: dt.date, end_date: dt.date) -> List[TransactionView]:
+        lo = bisect.bisect_left(self._ordinals, start_date.toordinal())
+        hi = bisect.bisect_right(self._ordinals, end_date.toordinal())
+        return [self._row(i) for i in range(lo, hi)]
+
+    def transactions_on(self, date: dt.date) -> List[TransactionView]:
+        return self.transactions_between(date, date)
+
+    def transactions_in_month(self, year: int, month: int) -> List[TransactionView]:
+        return self.transactions_between(dt.date(year, month, 1), end_of_month(year, month))
+
+
+class AccountMap(MutableMapping):
+    """accounts keyed by name, faulted in from a store on first access
+
+    the store provides names() -> set of stored account names and
+    load_account(name) -> Account
+    """
+    def __init__(self, store):
+        self.store = store
+        self.loaded: Dict[str, Account] = {}
+        self._names = set(store.names())
+
+    def __getitem__(self, name: str) -> Account:
+        if name not in self.loaded:
+            if name not in self._names:
+                raise KeyError(name)
+            self.loaded[name] = self.store.load_account(name)
+            stats.incr('ledger.accounts_loaded')
+        return self.loaded[name]
+
+    def __setitem__(self, name: str, acc: Account) -> None:
+        self.loaded[name] = acc
+        self._names.add(name)
+
+    def __delitem__(self, name: str) -> None:
+        self._names.remove(name)
+        self.loaded.pop(name, None)
+
+    def __contains__(self, name) -> bool:
+        return name in self._names
+
+    def __iter__(self):
+        return iter(sorted(self._names))
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+class BookTotals:
+    """bank-wide deposits, withdrawals, interest and carried balances per day in integer cents
+
+    days are kept sorted with cumulative sums like the Account index: a change
+    on a day truncates the sums from that day and the next query extends them
+    again, so chronological postings are O(1) and range queries are bisects.
+    the current balance of every account is kept alongside for top-N queries
+    """
+    COLUMNS = {'D': 0, 'W': 1, 'I': 2, 'B': 3}
+
     def __init__(self):
+        self._lock = threading.Lock()
+        self._days: List[dt.date] = []
+        self._flows: Dict[dt.date, List[int]] = {}
+        self._sums: List[tuple] = [(0, 0, 0, 0)]  # cumulative flows before day i
+        self.balances: Dict[str, int] = {}
+
+    def add(self, name: str, t, sign: int = 1) -> None:
+        """record one row, sign -1 takes a removed row back out"""
+        cents = sign * round(t.amount * 100)
+        with self._lock:
+            i = bisect.bisect_left(self._days, t.date)
+            if t.date not in self._flows:
+                self._days.insert(i, t.date)
+                self._flows[t.date] = [0, 0, 0, 0]
+            self._flows[t.date][self.COLUMNS[t.type]] += cents
+            del self._sums[i + 1:]
+            self.balances[name] = self.balances.get(name, 0) + (-cents if t.type == 'W' else cents)
+
+    def _sums_to(self, i: int) -> tuple:
+        # cumulative (deposits, withdrawals, interest, carried) over the first i days
+        while len(self._sums) <= i:
+            day = self._flows[self._days[len(self._sums) - 1]]
+            self._sums.append(tuple(a + b for a, b in zip(self._sums[-1], day)))
+        return self._sums[i]
+
+    def book_balance(self, date: dt.date) -> float:
+        with self._lock:
+            deposits, withdrawals, interest, carried = self._sums_to(bisect.bisect_right(self._days, date))
+        return (deposits - withdrawals + interest + carried) / 100
+
+    def flows(self, start_date: dt.date, end_date: dt.date) -> Dict[str, float]:
+        """flows between two days, archived days only show as carried balances"""
+        with self._lock:
+            lo = self._sums_to(bisect.bisect_left(self._days, start_date))
+            hi = self._sums_to(bisect.bisect_right(self._days, end_date))
+        deposits, withdrawals, interest, _ = (b - a for a, b in zip(lo, hi))
+        return {
+            'deposits': deposits / 100,
+            'withdrawals': withdrawals / 100,
+            'interest': interest / 100,
+            'net': (deposits - withdrawals + interest) / 100,
+        }
+
+    def top_balances(self, n: int) -> List[tuple]:
+        with self._lock:
+            top = heapq.nlargest(n, self.balances.items(), key=lambda item: item[1])
+        return [(name, cents / 100) for name, cents in top]
+
+
+class Ledger:
+    def __init__(self, account_cls=Account):
+        self.account_cls = account_cls
         self.accounts: Dict[str, Account] = {}
         self.rules: List[InterestRule] = []
+        self._timeline = None
+        # re-accrual tracking: earliest backdated change per account, and the
+        # dates of rule changes with how many of them each account has seen
+        self._dirty_from: Dict[str, dt.date] = {}
+        self._rule_changes: List[dt.date] = []
+        self._rules_seen: Dict[str, int] = {}
+        # bank-wide aggregates, built on first query and then kept current
+        self._totals: BookTotals = None
+        # rendered statements by (account, year_month), valid while the account
+        # version and rules version they were rendered at are unchanged
+        self.rules_version = 0
+        self._statement_cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # mutation history for as-of queries: seq counts transactions, rule
+        # changes and archives; each account keeps (seq, rows, is_base)
+        # snapshots without posted interest, a base when first changed and one
+        # after each archive, and an append-only log of the rows added with
+        # their seqs; rules a (seq, rules, date) copy per change. state writes
+        # history_entries() to disk and restore_history() reads them back, so
+        # seqs keep increasing across loads
+        self.seq = 0
+        self._created = time.time()
+        self._seq_times: List[float] = []
+        self._snapshots: Dict[str, List[tuple]] = {}
+        self._added: Dict[str, List[Transaction]] = {}
+        self._added_seqs: Dict[str, List[int]] = {}
+        self._rules_history: List[tuple] = []
+        self._history_saved = 0  # history through this seq is on disk
+        self._history_started = False  # the start record is on disk
+        self._history_changed: Dict[str, int] = {}  # account -> last seq of its history
+        self._restored_seq = 0
+        self._restored_counts: Dict[str, int] = {}  # history rows per account at _restored_seq
+        self._touched: Set[str] = set()  # accounts changed since the history was restored
+        self._seq_lock = threading.RLock()
+        # thread safety: lock order is rules -> account -> accounts map
+        self._rules_lock = RWLock()
+        self._accounts_lock = threading.Lock()
+        self._account_locks: Dict[str, threading.RLock] = {}
 
     # --- helpers -------------------------------------------------------------------
     def _parse_year_month(self, year_month: str) -> (int, int):
@@ -81,56 +542,226 @@ class Ledger:
             raise ValueError('Invalid month')
         return year, month
 
-    def _compute_interest_for_month(self, acc: Account, year: int, month: int) -> float:
+    @staticmethod
+    def _next_month(year: int, month: int) -> (int, int):
+        if month == 12:
+            return year + 1, 1
+        return year, month + 1
+
+    def _rate_timeline(self) -> (List[dt.date], List[float]):
+        # bisectable (dates, rates) view of the sorted rules, rebuilt on change
+        if self._timeline is None:
+            self._timeline = ([r.date for r in self.rules], [r.rate for r in self.rules])
+        return self._timeline
+
+    def _rate_segments(self, year: int, month: int) -> List[tuple]:
+        """(start date, rate) breakpoints of the rate timeline within the month"""
         start_date = dt.date(year, month, 1)
         end_date = end_of_month(year, month)
-        balance = acc.balance_before(start_date)
-        txns_by_day: Dict[dt.date, List[Transaction]] = {}
-        for t in acc.transactions_in_month(year, month):
-            txns_by_day.setdefault(t.date, []).append(t)
+        dates, rates = self._rate_timeline()
+        segments = [(start_date, self._rate_for_date(start_date))]
+        i = bisect.bisect_right(dates, start_date)
+        while i < len(dates) and dates[i] <= end_date:
+            segments.append((dates[i], rates[i]))
+            i += 1
+        stats.incr('ledger.rules_scanned', len(segments))
+        return segments
+
+    def _compute_interest_for_month(self, acc: Account, year: int, month: int, segments: List[tuple] = None) -> float:
+        # integrate balance x rate over the constant segments between
+        # transaction dates and rule changes instead of every calendar day
+        if segments is None:
+            segments = self._rate_segments(year, month)
+        stop_date = end_of_month(year, month) + dt.timedelta(days=1)
+        breaks = sorted({d for d, _ in segments} | {t.date for t in acc.transactions_in_month(year, month)})
         interest_total = 0.0
-        day = start_date
-        while day <= end_date:
-            day_txns = txns_by_day.get(day, [])
-            for t in day_txns:
-                if t.type == 'D':
-                    balance += t.amount
-                elif t.type == 'W':
-                    balance -= t.amount
-                elif t.type == 'I':
-                    balance += t.amount
-            rate = self._rate_for_date(day)
-            interest_total += balance * rate
-            day += dt.timedelta(days=1)
+        rate = 0.0
+        j = 0
+        for i, day in enumerate(breaks):
+            while j < len(segments) and segments[j][0] <= day:
+                rate = segments[j][1]
+                j += 1
+            next_day = breaks[i + 1] if i + 1 < len(breaks) else stop_date
+            interest_total += acc.balance_through(day) * rate * (next_day - day).days
+        stats.incr('ledger.accrual_months')
+        stats.incr('ledger.accrual_segments', len(breaks))
+        stats.incr('ledger.accrual_days', (stop_date - breaks[0]).days)
         monthly_interest = round(interest_total / 100 / 365, 2)
         return monthly_interest
 
+    @staticmethod
+    def _opened(acc: Account) -> dt.date:
+        """first day interest accrues from, the day after a carry-forward checkpoint"""
+        first = acc.transactions[0]
+        return first.date + dt.timedelta(days=1) if first.type == 'B' else first.date
+
+    @staticmethod
+    def _archived_through(acc: Account) -> dt.date:
+        if acc.transactions and acc.transactions[0].type == 'B':
+            return acc.transactions[0].date
+        return None
+
+    @staticmethod
+    def _has_interest(acc: Account, eom: dt.date) -> bool:
+        return any(t.type == 'I' for t in acc.transactions_on(eom))
+
+    @staticmethod
+    def _has_interest_from(acc: Account, date: dt.date) -> bool:
+        """any interest posted on or after date, which a change dated date makes stale"""
+        if not acc.transactions:
+            return False
+        return any(t.type == 'I' for t in acc.transactions_between(date, acc.transactions[-1].date))
+
+    def _post_interest(self, acc: Account, eom: dt.date, interest: float) -> Transaction:
+        txn_id = f"{eom.strftime(TXN_DATE_FORMAT)}-I"
+        txn = Transaction(date=eom, txn_id=txn_id, type='I', amount=interest)
+        acc.add_transaction(txn)
+        self._record(acc.name, [txn])
+        return txn
+
+    def _dirty_date(self, name: str) -> dt.date:
+        """earliest date from which the account's posted interest is stale"""
+        dates = self._rule_changes[self._rules_seen.get(name, 0):]
+        if name in self._dirty_from:
+            dates = dates + [self._dirty_from[name]]
+        return min(dates) if dates else None
+
+    def _refresh_interest(self, acc: Account) -> None:
+        # unpost the stale months so the accrual loop recomputes only those
+        dirty = self._dirty_date(acc.name)
+        if dirty is not None:
+            self._record(acc.name, acc.remove_interest_from(dirty), sign=-1)
+        self._dirty_from.pop(acc.name, None)
+        self._rules_seen[acc.name] = len(self._rule_changes)
+
     def _accrue_interest(self, acc, year_month: str) -> None:
         year, month = self._parse_year_month(year_month)
+        self._refresh_interest(acc)
         if not acc.transactions:
             print('INFO. no transactions for this account.')
             return
-        start_date = min(t.date for t in acc.transactions)
+        start_date = self._opened(acc)
         curr_year, curr_month = start_date.year, start_date.month
         while (curr_year < year) or (curr_year == year and curr_month <= month):
             eom = end_of_month(curr_year, curr_month)
-            if not any(t.type == 'I' and t.date == eom for t in acc.transactions):
+            if not self._has_interest(acc, eom):
                 interest = self._compute_interest_for_month(acc, curr_year, curr_month)
-                txn_id = f"{eom.strftime(TXN_DATE_FORMAT)}-I"
-                acc.add_transaction(
-                    Transaction(date=eom, txn_id=txn_id, type='I', amount=interest)
-                )
-            if curr_month == 12:
-                curr_month = 1
-                curr_year += 1
-            else:
-                curr_month += 1
+                self._post_interest(acc, eom, interest)
+            curr_year, curr_month = self._next_month(curr_year, curr_month)
+
+    def close_month(self, year_month: str) -> Dict:
+        """post the month-end interest for every account in one batched pass"""
+        year, month = self._parse_year_month(year_month)
+        with self._rules_lock.read(), ExitStack() as locks:
+            for name in sorted(self._account_names()):
+                locks.enter_context(self._account_lock(name))
+            return self._close_month(year, month)
+
+    def _close_month(self, year: int, month: int) -> Dict:
+        open_accounts = [
+            acc for acc in self.accounts.values()
+            if acc.transactions and self._opened(acc) <= end_of_month(year, month)
+        ]
+        posted = 0
+        interest = 0.0
+        for acc in open_accounts:
+            self._refresh_interest(acc)
+        if open_accounts:
+            start_date = min(self._opened(acc) for acc in open_accounts)
+            curr_year, curr_month = start_date.year, start_date.month
+            # catch up any earlier unclosed months first, the rate segments
+            # are built once per month for the whole book
+            while (curr_year < year) or (curr_year == year and curr_month <= month):
+                eom = end_of_month(curr_year, curr_month)
+                segments = self._rate_segments(curr_year, curr_month)
+                for acc in open_accounts:
+                    if self._opened(acc) > eom or self._has_interest(acc, eom):
+                        continue
+                    txn = self._post_interest(
+                        acc, eom, self._compute_interest_for_month(acc, curr_year, curr_month, segments)
+                    )
+                    if (curr_year, curr_month) == (year, month):
+                        posted += 1
+                        interest += txn.amount
+                curr_year, curr_month = self._next_month(curr_year, curr_month)
+        return {
+            'accounts': len(open_accounts),
+            'posted': posted,
+            'interest': round(interest, 2),
+        }
+
+    # --- archival ---
+    def archive(self, year_month: str) -> Dict[str, List[Dict]]:
+        """fold every month up to year_month into a carry-forward row per account
+
+        the months are accrued first so the checkpoint balance includes their
+        interest; returns the folded rows per account for the cold archive
+        """
+        year, month = self._parse_year_month(year_month)
+        today = dt.date.today()
+        if (year, month) >= (today.year, today.month):
+            # the current and later months are still open for postings and accrual
+            raise ValueError('Only months before the current month can be archived')
+        cutoff = end_of_month(year, month)
+        archived = {}
+        with self._rules_lock.read(), ExitStack() as locks:
+            names = sorted(self._account_names())
+            for name in names:
+                locks.enter_context(self._account_lock(name))
+            self._close_month(year, month)
+            with self._seq_lock:
+                seq = self._next_seq()
+                for name in names:
+                    acc = self.accounts[name]
+                    self._remember_base(acc, seq)
+                    folded = acc.checkpoint(cutoff)
+                    if folded:
+                        archived[name] = self._txns_data(folded)
+                        self._snapshots.setdefault(name, []).append((seq, self._history_rows(acc), False))
+                        self._history_changed[name] = seq
+            # carried balances replace the folded days, refold on next query
+            self._totals = None
+        return archived
+
+    def is_archived(self, account_name: str, year_month: str) -> bool:
+        year, month = self._parse_year_month(year_month)
+        acc = self._find_account(account_name)
+        if not acc:
+            raise ValueError('Account not found')
+        with self._account_lock(account_name):
+            archived = self._archived_through(acc)
+        return archived is not None and dt.date(year, month, 1) <= archived
+
+    def archived_statement(self, account_name: str, year_month: str, rows: List[Dict]) -> Dict[str, str]:
+        """statement of an archived month rendered from its cold archive rows
+
+        the rows hold every archived transaction and interest posting of the
+        account, so no accrual is needed
+        """
+        year, month = self._parse_year_month(year_month)
+        acc = Ledger.from_dict({'accounts': {account_name: rows}}).accounts[account_name]
+        return self._render_statement(acc, year, month)
 
     # --- account and transaction handling ---
+    def _account_lock(self, name: str) -> threading.RLock:
+        with self._accounts_lock:
+            if name not in self._account_locks:
+                self._account_locks[name] = threading.RLock()
+            return self._account_locks[name]
+
+    def _account_names(self) -> List[str]:
+        with self._accounts_lock:
+            return list(self.accounts)
+
+    def _find_account(self, name: str) -> Account:
+        with self._accounts_lock:
+            return self.accounts.get(name)
+
     def _get_account(self, name: str) -> Account:
-        if name not in self.accounts:
-            self.accounts[name] = Account(name)
-        return self.accounts[name]
+        with self._accounts_lock:
+            if name not in self.accounts:
+                self.accounts[name] = self.account_cls(name)
+            return self.accounts[name]
 
     def add_transaction(self, date_str: str, account_name: str, t_type: str, amount: float) -> Transaction:
         date = dt.datetime.strptime(date_str, TXN_DATE_FORMAT).date()
@@ -139,142 +770,660 @@ class Ledger:
             raise ValueError('Type must be D or W')
         if amount <= 0:
             raise ValueError('Amount must be greater than 0')
+        with self._account_lock(account_name):
+            return self._add_transaction(date, date_str, account_name, t_type, amount)
+
+    def _add_transaction(self, date: dt.date, date_str: str, account_name: str, t_type: str, amount: float) -> Transaction:
+        # balance check, txn id and insert happen under the account lock
         acc = self._get_account(account_name)
+        archived = self._archived_through(acc)
+        if archived is not None and date <= archived:
+            raise ValueError('Date falls in an archived month')
         # check balance for withdrawal
         if t_type == 'W':
-            bal_before = acc.balance_before(date)
-            # also include earlier transactions same day before this one
-            for t in acc.transactions:
-                if t.date == date:
-                    if t.type.upper() == 'D':
-                        bal_before += t.amount
-                    elif t.type.upper() in ('W', 'I'):
-                        bal_before -= t.amount
+            # include earlier transactions same day before this one
+            bal_before = acc.balance_through(date)
             if bal_before - amount < 0:
                 raise ValueError('Balance cannot go below 0')
         # generate txn id
-        count = len([t for t in acc.transactions if t.date == date]) + 1
+        count = len(acc.transactions_on(date)) + 1
         txn_id = f"{date_str}-{count:02d}"
         txn = Transaction(date=date, txn_id=txn_id, type=t_type, amount=round(amount, 2))
+        with self._seq_lock:
+            seq = self._next_seq()
+            self._remember_base(acc, seq)
+            self._remember(acc, seq, txn)
         acc.add_transaction(txn)
+        self._record(account_name, [txn])
+        if self._has_interest_from(acc, date):
+            # backdated before posted interest
+            self._dirty_from[account_name] = min(date, self._dirty_from.get(account_name, date))
         return txn
 
+    def import_transactions(self, rows) -> (int, List[Dict]):
+        """add a batch of (row_no, [date, account, type, amount]) rows
+
+        rows are validated in chronological order per account, keeping the
+        input order for same-day rows, and errors are reported per row
+        """
+        errors = []
+        valid = []
+        for row_no, fields in rows:
+            if len(fields) != 4:
+                errors.append({'row': row_no, 'success': -1, 'error': 'Invalid input. Expected 4 fields.'})
+            else:
+                valid.append((fields[1], fields[0], row_no, fields))
+        valid.sort(key=lambda r: r[:3])
+        imported = 0
+        for account_name, date_str, row_no, fields in valid:
+            try:
+                self.add_transaction(date_str, account_name, fields[2], float(fields[3]))
+            except Exception as e:
+                errors.append({'row': row_no, 'success': -1, 'error': str(e)})
+            else:
+                imported += 1
+        errors.sort(key=lambda e: e['row'])
+        return imported, errors
+
+    # --- bank-wide aggregates ---
+    def _record(self, name: str, txns, sign: int = 1) -> None:
+        # called under the account lock for every row added or removed
+        if self._totals is not None:
+            for t in txns:
+                self._totals.add(name, t, sign)
+
+    def _book(self) -> BookTotals:
+        """aggregates folded from every account on first use
+
+        the fold holds all account locks; it is retried if an account was
+        created meanwhile, whose rows would otherwise be missed
+        """
+        while self._totals is None:
+            names = sorted(self._account_names())
+            with ExitStack() as locks:
+                for name in names:
+                    locks.enter_context(self._account_lock(name))
+                totals = BookTotals()
+                for name in names:
+                    for t in self._find_account(name).transactions:
+                        totals.add(name, t)
+                with self._accounts_lock:
+                    if len(self.accounts) == len(names):
+                        self._totals = totals
+        return self._totals
+
+    def book_balance(self, date_str: str) -> float:
+        """total of all account balances at the end of the day, with posted interest"""
+        return self._book().book_balance(dt.datetime.strptime(date_str, TXN_DATE_FORMAT).date())
+
+    def flows(self, from_date_str: str, to_date_str: str) -> Dict[str, float]:
+        """bank-wide deposits, withdrawals, posted interest and net flow between two days inclusive"""
+        start_date = dt.datetime.strptime(from_date_str, TXN_DATE_FORMAT).date()
+        end_date = dt.datetime.strptime(to_date_str, TXN_DATE_FORMAT).date()
+        if start_date > end_date:
+            raise ValueError('Start date must not be after end date')
+        return self._book().flows(start_date, end_date)
+
+    def top_balances(self, n: int = 10) -> List[tuple]:
+        """(account, balance) of the n largest current balances"""
+        return self._book().top_balances(n)
+
+    # --- history ---
+    def _next_seq(self) -> int:
+        with self._seq_lock:
+            self.seq += 1
+            self._seq_times.append(time.time())
+            return self.seq
+
+    @staticmethod
+    def _history_rows(acc) -> tuple:
+        # posted interest is derived, accrual recomputes it on reconstruction
+        return tuple(t for t in acc.transactions if t.type != 'I')
+
+    def _remember_base(self, acc, seq: int) -> None:
+        # rows as loaded, captured before the account's first mutation; called
+        # under the account and seq locks. restored history that already ends
+        # at the loaded rows carries on without a new base
+        if acc.name in self._touched:
+            return
+        self._touched.add(acc.name)
+        rows = self._history_rows(acc)
+        if len(rows) != self._restored_counts.get(acc.name):
+            self._snapshots.setdefault(acc.name, []).append((seq - 1, rows, True))
+            self._history_changed[acc.name] = seq
+        self._added.setdefault(acc.name, [])
+        self._added_seqs.setdefault(acc.name, [])
+
+    def _remember(self, acc, seq: int, txn: Transaction) -> None:
+        self._added[acc.name].append(txn)
+        self._added_seqs[acc.name].append(seq)
+        self._history_changed[acc.name] = seq
+
+    def history_entries(self) -> (List[Dict], int):
+        """history recorded since the last history_saved() as records for the
+        on-disk log, and the seq they run to"""
+        with self._seq_lock:
+            since, upto = self._history_saved, self.seq
+            entries = []
+            if not self._history_started:
+                entries.append({'op': 'start', 'seq': 0, 'time': self._created})
+            for seq, rules, date in self._rules_history:
+                # a base is taken at seq - 1 of the change that needed it
+                if seq > since or date is None and seq == since:
+                    entry = {'op': 'R', 'seq': seq, 'rules': self._rules_data(rules)}
+                    if date is not None:
+                        entry['date'] = date.strftime(TXN_DATE_FORMAT)
+                    entries.append(entry)
+            for name, last in list(self._history_changed.items()):
+                if last <= since:
+                    del self._history_changed[name]
+                    continue
+                for seq, rows, is_base in self._snapshots.get(name, ()):
+                    if seq > since or is_base and seq == since:
+                        entries.append({'op': 'base' if is_base else 'A', 'seq': seq, 'account': name,
+                                        'rows': self._txns_data(rows)})
+                seqs, added = self._added_seqs[name], self._added[name]
+                for i in range(bisect.bisect_right(seqs, since), len(seqs)):
+                    entries.append({'op': 'T', 'seq': seqs[i], 'account': name, **self._txns_data([added[i]])[0]})
+            for entry in entries:
+                if entry['op'] != 'base' and entry['seq'] > 0 and ('date' in entry or entry['op'] != 'R'):
+                    entry['time'] = self._seq_times[entry['seq'] - 1]
+            entries.sort(key=lambda e: e['seq'])
+            return entries, upto
+
+    def history_saved(self, seq: int) -> None:
+        """mark the entries through seq as written"""
+        with self._seq_lock:
+            self._history_saved = max(self._history_saved, seq)
+            self._history_started = True
+
+    def restore_history(self, entries) -> None:
+        """replace the history with the history_entries() records read back from disk"""
+        with self._seq_lock:
+            self.seq = 0
+            self._seq_times = []
+            self._history_started = False
+            self._snapshots = {}
+            self._added = {}
+            self._added_seqs = {}
+            self._rules_history = []
+            for entry in entries:
+                op, seq = entry['op'], entry['seq']
+                if op == 'start':
+                    self._created = entry['time']
+                    self._history_started = True
+                elif op in ('base', 'A'):
+                    rows = tuple(
+                        Transaction(date=parse_date(t['date']), txn_id=t['txn_id'], type=t['type'], amount=t['amount'])
+                        for t in entry['rows']
+                    )
+                    self._snapshots.setdefault(entry['account'], []).append((seq, rows, op == 'base'))
+                    self._added.setdefault(entry['account'], [])
+                    self._added_seqs.setdefault(entry['account'], [])
+                elif op == 'T':
+                    self._added_seqs.setdefault(entry['account'], [])
+                    self._added.setdefault(entry['account'], []).append(
+                        Transaction(date=parse_date(entry['date']), txn_id=entry['txn_id'], type=entry['type'],
+                                    amount=entry['amount'])
+                    )
+                    self._added_seqs[entry['account']].append(seq)
+                elif op == 'R':
+                    rules = tuple(
+                        InterestRule(date=parse_date(r['date']), rule_id=r['rule_id'], rate=r['rate'])
+                        for r in entry['rules']
+                    )
+                    self._rules_history.append((seq, rules, parse_date(entry['date']) if 'date' in entry else None))
+                if 'time' in entry and seq > 0:
+                    # seqs without a record of their own (an archive that folded nothing) take the next time
+                    self._seq_times.extend([entry['time']] * (seq - len(self._seq_times)))
+                self.seq = max(self.seq, seq)
+            self._restored_counts = {}
+            for name, snapshots in self._snapshots.items():
+                snapshot_seq, rows, _ = snapshots[-1]
+                seqs = self._added_seqs[name]
+                self._restored_counts[name] = len(rows) + len(seqs) - bisect.bisect_right(seqs, snapshot_seq)
+            self._history_saved = self._restored_seq = self.seq
+            self._history_changed = {}
+            self._touched = set()
+
+    def _as_of_seq(self, as_of) -> int:
+        if isinstance(as_of, dt.datetime):
+            timestamp = as_of.timestamp()
+            if timestamp < self._created:
+                raise ValueError('No history before the ledger was loaded')
+            with self._seq_lock:
+                return bisect.bisect_right(self._seq_times, timestamp)
+        if not 0 <= as_of <= self.seq:
+            raise ValueError('Unknown sequence number')
+        return as_of
+
+    def _rows_as_of(self, account_name: str, seq: int, restated: dt.date = None) -> List[Transaction]:
+        """rows at seq plus the live posted interest still valid for them
+
+        interest is kept for the months before the earliest of restated (the
+        first date a later rule change touches), the dates of rows added after
+        seq and the account's own dirty date, so accrual only redoes the tail
+        """
+        acc = self._find_account(account_name)
+        if not acc:
+            return []
+        with self._account_lock(account_name):
+            snapshots = self._snapshots.get(account_name)
+            if snapshots is None or account_name not in self._touched and seq >= self._restored_seq:
+                # not changed since it was loaded
+                base_seq, rows, seqs, added = seq, self._history_rows(acc), [], []
+            else:
+                # nearest base at or before seq, then replay the logged rows after it
+                i = max(bisect.bisect_right(snapshots, seq, key=lambda s: s[0]) - 1, 0)
+                base_seq, rows, _ = snapshots[i]
+                seqs, added = self._added_seqs[account_name], self._added[account_name]
+            lo = bisect.bisect_right(seqs, base_seq)
+            hi = bisect.bisect_right(seqs, seq)
+            stats.incr('ledger.history_replayed', max(hi - lo, 0))
+            changes = [t.date for t in added[hi:]] + [restated, self._dirty_date(account_name)]
+            valid = min((date for date in changes if date is not None), default=None)
+            posted = acc.transactions if valid is None else acc.transactions_between(dt.date.min, valid - dt.timedelta(days=1))
+            interest = [t for t in posted if t.type == 'I']
+            return list(rows) + added[lo:hi] + interest
+
+    def _rules_as_of(self, seq: int) -> (List[InterestRule], dt.date):
+        """rules in force at seq and the earliest date a later rule change restates"""
+        with self._rules_lock.read():
+            if not self._rules_history:
+                return list(self.rules), None
+            i = max(bisect.bisect_right(self._rules_history, seq, key=lambda r: r[0]) - 1, 0)
+            restated = min((date for _, _, date in self._rules_history[i + 1:]), default=None)
+            return list(self._rules_history[i][1]), restated
+
+    def _ledger_as_of(self, account_name: str, as_of) -> 'Ledger':
+        """separate ledger holding the account and rules as they were at as_of"""
+        seq = self._as_of_seq(as_of)
+        rules, restated = self._rules_as_of(seq)
+        rows = self._rows_as_of(account_name, seq, restated)
+        if not rows:
+            raise ValueError('Account not found')
+        ledger = Ledger(account_cls=self.account_cls)
+        ledger.rules = rules
+        ledger.accounts[account_name] = self.account_cls(account_name, rows)
+        return ledger
+
+    def balance_as_of(self, account_name: str, date_str: str, as_of=None) -> float:
+        """end of day balance with interest accrued through the day's month,
+        as known at the given mutation seq or time (now when None)"""
+        date = dt.datetime.strptime(date_str, TXN_DATE_FORMAT).date()
+        ledger = self._ledger_as_of(account_name, self.seq if as_of is None else as_of)
+        acc = ledger.accounts[account_name]
+        archived = ledger._archived_through(acc)
+        if archived is not None and date <= archived:
+            raise ValueError('Month is archived')
+        ledger._accrue_interest(acc, date.strftime('%Y%m'))
+        return round(acc.balance_through(date), 2)
+
+    # --- rule simulation ---
+    def simulate_rules(self, schedules: Dict[str, List[Dict]], from_year_month: str, to_year_month: str) -> Dict[str, Dict]:
+        """interest each candidate rule schedule would have paid, without touching the ledger
+
+        schedules map a scenario name to rules in the to_dict() format. balances
+        at the start of from_year_month are the actual ones; within the range
+        posted interest is replaced by each scenario's own, compounded monthly.
+        daily balances are built once per account and month and each scenario's
+        daily rate vector is applied to them
+        """
+        from_year, from_month = self._parse_year_month(from_year_month)
+        to_year, to_month = self._parse_year_month(to_year_month)
+        if (from_year, from_month) > (to_year, to_month):
+            raise ValueError('Start month must not be after end month')
+        months = []
+        year, month = from_year, from_month
+        while (year, month) <= (to_year, to_month):
+            months.append([dt.date(year, month, day) for day in range(1, end_of_month(year, month).day + 1)])
+            year, month = self._next_month(year, month)
+        # per scenario and month: daily rates and their sum
+        rates = {
+            scenario: [(r, sum(r)) for r in self._daily_rates(rules, months)]
+            for scenario, rules in schedules.items()
+        }
+        results = {scenario: {'accounts': {}, 'total': 0.0} for scenario in schedules}
+        with stats.timed('ledger.simulate'):
+            for name in self._account_names():
+                acc = self._find_account(name)
+                with self._account_lock(name):
+                    opening = acc.balance_before(months[0][0])
+                    rows = [t for t in acc.transactions_between(months[0][0], months[-1][-1]) if t.type != 'I']
+                daily = self._daily_balances(opening, rows, months)
+                for scenario, month_rates in rates.items():
+                    carried = 0.0
+                    for balances, (day_rates, rate_days) in zip(daily, month_rates):
+                        total = sum(map(operator.mul, balances, day_rates)) + carried * rate_days
+                        carried = round(carried + round(total / 100 / 365, 2), 2)
+                    results[scenario]['accounts'][name] = carried
+                    results[scenario]['total'] += carried
+                stats.incr('ledger.simulated_accounts')
+        for result in results.values():
+            result['total'] = round(result['total'], 2)
+        return results
+
+    @staticmethod
+    def _daily_rates(rules: List[Dict], months: List[List[dt.date]]) -> List[List[float]]:
+        timeline = {}
+        for r in rules:
+            if not (0 < r['rate'] < 100):
+                raise ValueError('Rate must be between 0 and 100')
+            # a later rule on the same date replaces the earlier one, as in add_rule
+            timeline[dt.datetime.strptime(r['date'], TXN_DATE_FORMAT).date()] = r['rate']
+        dates = sorted(timeline)
+        rates = [timeline[d] for d in dates]
+        return [
+            [rates[i - 1] if (i := bisect.bisect_right(dates, day)) else 0.0 for day in days]
+            for days in months
+        ]
+
+    @staticmethod
+    def _daily_balances(opening: float, rows, months: List[List[dt.date]]) -> List[List[float]]:
+        # end-of-day balances without posted interest, rows are in date order
+        balance = opening
+        i = 0
+        daily = []
+        for days in months:
+            balances = []
+            for day in days:
+                while i < len(rows) and rows[i].date <= day:
+                    balance += -rows[i].amount if rows[i].type == 'W' else rows[i].amount
+                    i += 1
+                balances.append(balance)
+            daily.append(balances)
+        return daily
+
     # --- interest rules ---
     def add_rule(self, date_str: str, rule_id: str, rate: float) -> InterestRule:
         if not (0 < rate < 100):
             raise ValueError('Rate must be between 0 and 100')
         date = dt.datetime.strptime(date_str, TXN_DATE_FORMAT).date()
-        # remove existing rule same date
-        self.rules = [r for r in self.rules if r.date != date]
         rule = InterestRule(date=date, rule_id=rule_id, rate=rate)
-        self.rules.append(rule)
-        self.rules.sort(key=lambda r: r.date)
+        with self._rules_lock.write():
+            # remove existing rule same date
+            rules = [r for r in self.rules if r.date != date]
+            rules.append(rule)
+            rules.sort(key=lambda r: r.date)
+            with self._seq_lock:
+                seq = self._next_seq()
+                if not self._rules_history:
+                    self._rules_history.append((seq - 1, tuple(self.rules), None))
+                self._rules_history.append((seq, tuple(rules), date))
+            self.rules = rules
+            self._timeline = None
+            self._rule_changes.append(date)
+            self.rules_version += 1
         return rule
 
     def _rate_for_date(self, date: dt.date) -> float:
-        applicable = [r for r in self.rules if r.date <= date]
-        if not applicable:
+        dates, rates = self._rate_timeline()
+        i = bisect.bisect_right(dates, date)
+        if not i:
             return 0.0
-        return applicable[-1].rate
+        return rates[i - 1]
 
     @staticmethod
-    def _add_txn_line(lines, date, amount, txn_id, txn_type, end_bal, type_pad: str ='    '):
-        txn_line = f"| {date.strftime(TXN_DATE_FORMAT)} | {txn_id:<11} | {txn_type}{type_pad}| {amount:7.2f} | {end_bal:8.2f} |"
-        lines.append(txn_line)
-        return lines
+    def _txn_line(date, amount, txn_id, txn_type, end_bal, type_pad: str ='    ') -> str:
+        return f"| {date.strftime(TXN_DATE_FORMAT)} | {txn_id:<11} | {txn_type}{type_pad}| {amount:7.2f} | {end_bal:8.2f} |"
 
     # --- statement ---
-    def statement(self, account_name: str, year_month: str) -> Dict[str, str]:
+    def statement(self, account_name: str, year_month: str, as_of=None) -> Dict[str, str]:
+        """statement for the month; with as_of, as the ledger showed it at that
+        mutation seq (int) or time (datetime), before later entries and rule changes
+        """
+        if as_of is not None:
+            self._parse_year_month(year_month)
+            return self._ledger_as_of(account_name, as_of).statement(account_name, year_month)
+        return self.statement_cached(account_name, year_month)[0]
+
+    def statement_cached(self, account_name: str, year_month: str) -> (Dict[str, str], bool):
+        """statement and whether it was served from the cache without accruing"""
         year, month = self._parse_year_month(year_month)
-        acc = self.accounts.get(account_name)
+        acc = self._find_account(account_name)
         if not acc:
             raise ValueError('Account not found')
-        
-        self._accrue_interest(acc, year_month)
-        transactions = acc.transactions_in_month(year, month)
-        start_date = dt.date(year, month, 1)
-        balance = acc.balance_before(start_date)
-
-        lines = [f"Account: {account_name}", "| Date     | Txn Id      | Type | Amount  | Balance  |"]
-        lines = self._add_txn_line(
-            lines,
-            start_date,
-            balance,
-            '',
-            'BAL',
-            balance,
-            type_pad='  '
-        )
 
-        interest = 0
+        with self._rules_lock.read(), self._account_lock(account_name):
+            archived = self._archived_through(acc)
+            if archived is not None and dt.date(year, month, 1) <= archived:
+                raise ValueError('Month is archived')
+            result = self._cached_statement(acc, year_month)
+            if result is not None:
+                return result, True
+            with stats.timed('ledger.accrue'):
+                self._accrue_interest(acc, year_month)
+            with stats.timed('ledger.render'):
+                result = self._render_statement(acc, year, month)
+            self._cache_statement(acc, year_month, result)
+            return dict(result), False
+
+    def _cached_statement(self, acc, year_month: str) -> Dict[str, str]:
+        # a matching version means accrual would post nothing, so the rendered
+        # statement is still what statement() would return
+        key = (acc.name, year_month)
+        with self._cache_lock:
+            entry = self._statement_cache.get(key)
+            if entry is None or entry[:2] != (acc.version, self.rules_version):
+                stats.incr('ledger.statement_cache_misses')
+                return None
+            self._statement_cache.move_to_end(key)
+        stats.incr('ledger.statement_cache_hits')
+        return dict(entry[2])
+
+    def _cache_statement(self, acc, year_month: str, result: Dict[str, str]) -> None:
+        with self._cache_lock:
+            self._statement_cache[(acc.name, year_month)] = (acc.version, self.rules_version, result)
+            self._statement_cache.move_to_end((acc.name, year_month))
+            while len(self._statement_cache) > STATEMENT_CACHE_SIZE:
+                self._statement_cache.popitem(last=False)
+                stats.incr('ledger.statement_cache_evictions')
+
+    def _month_lines(self, account_name: str, start_date: dt.date, balance: float, transactions):
+        """yield the statement lines of one month, returning the closing balance"""
+        yield f"Account: {account_name}"
+        yield "| Date     | Txn Id      | Type | Amount  | Balance  |"
+        yield self._txn_line(start_date, balance, '', 'BAL', balance, type_pad='  ')
         for t in transactions:
             if t.type in ['D', 'I']:
                 balance += t.amount
             elif t.type == 'W':
                 balance -= t.amount
-            elif t.type == 'I':
-                interest += t.amount
             display_id = '' if t.type == 'I' else t.txn_id
-            lines = self._add_txn_line(
-                lines,
-                t.date,
-                t.amount,
-                display_id,
-                t.type,
-                balance
-            )
+            yield self._txn_line(t.date, t.amount, display_id, t.type, balance)
+        return balance
+
+    def _render_statement(self, acc, year: int, month: int) -> Dict[str, str]:
+        transactions = acc.transactions_in_month(year, month)
+        start_date = dt.date(year, month, 1)
+        lines = self._month_lines(acc.name, start_date, acc.balance_before(start_date), transactions)
         statement_text = '\n'.join(lines)
+        interest = round(sum(t.amount for t in transactions if t.type == 'I'), 2)
         return {
             'statement': statement_text,
             'interest': interest
         }
 
+    def statement_range(self, account_name: str, from_year_month: str, to_year_month: str):
+        """statement lines for a range of months, streamed from a single walk
+
+        accrual runs once up to the last month, then the generator walks the
+        account's rows in the range carrying the running balance across months,
+        with a blank line between months
+        """
+        from_year, from_month = self._parse_year_month(from_year_month)
+        to_year, to_month = self._parse_year_month(to_year_month)
+        if (from_year, from_month) > (to_year, to_month):
+            raise ValueError('Start month must not be after end month')
+        acc = self._find_account(account_name)
+        if not acc:
+            raise ValueError('Account not found')
+        with self._rules_lock.read(), self._account_lock(account_name):
+            start_date = dt.date(from_year, from_month, 1)
+            archived = self._archived_through(acc)
+            if archived is not None and start_date <= archived:
+                raise ValueError('Month is archived')
+            with stats.timed('ledger.accrue'):
+                self._accrue_interest(acc, to_year_month)
+            balance = acc.balance_before(start_date)
+            # row references for the range, taken under the lock
+            rows = acc.transactions_between(start_date, end_of_month(to_year, to_month))
+        return self._range_lines(account_name, rows, balance, from_year, from_month, to_year, to_month)
+
+    def _range_lines(self, account_name: str, rows, balance: float, year: int, month: int, to_year: int, to_month: int):
+        i = 0
+        while (year, month) <= (to_year, to_month):
+            start_date = dt.date(year, month, 1)
+            end_date = end_of_month(year, month)
+            j = i
+            while j < len(rows) and rows[j].date <= end_date:
+                j += 1
+            balance = yield from self._month_lines(account_name, start_date, balance, rows[i:j])
+            i = j
+            year, month = self._next_month(year, month)
+            if (year, month) <= (to_year, to_month):
+                yield ''
+
+    @classmethod
+    def _account_data(cls, acc: Account) -> List[Dict]:
+        return cls._txns_data(acc.transactions)
+
+    @staticmethod
+    def _txns_data(transactions) -> List[Dict]:
+        return [
+            {
+                'date': t.date.strftime(TXN_DATE_FORMAT),
+                'txn_id': t.txn_id,
+                'type': t.type,
+                'amount': t.amount,
+            }
+            for t in transactions
+        ]
+
+    def _rules_data(self, rules: List[InterestRule] = None) -> List[Dict]:
+        return [
+            {
+                'date': r.date.strftime(TXN_DATE_FORMAT),
+                'rule_id': r.rule_id,
+                'rate': r.rate,
+            }
+            for r in (self.rules if rules is None else rules)
+        ]
+
+    def snapshot(self, names) -> 'Ledger':
+        """independent ledger holding copies of the named accounts and the rules"""
+        ledger = Ledger(account_cls=self.account_cls)
+        with self._rules_lock.read():
+            for name in names:
+                acc = self._find_account(name)
+                if acc is None:
+                    continue
+                with self._account_lock(name):
+                    ledger.accounts[name] = self.account_cls(name, list(acc.transactions))
+                    dirty = self._dirty_date(name)
+                if dirty is not None:
+                    ledger._dirty_from[name] = dirty
+            ledger.rules = list(self.rules)
+        return ledger
+
+    def statements_for_month(self, year_month: str, workers: int = 1) -> Dict[str, Dict]:
+        """statement for every account, accrual and rendering spread over a process pool"""
+        self._parse_year_month(year_month)
+        names = self._account_names()
+        if workers <= 1 or len(names) < 2:
+            return {name: self.statement(name, year_month) for name in names}
+        with self._rules_lock.read():
+            return self._statements_for_month(names, year_month, workers)
+
+    def _statements_for_month(self, names: List[str], year_month: str, workers: int) -> Dict[str, Dict]:
+        # resolve stale interest here so workers only ever append postings
+        data, versions = {}, {}
+        for name in names:
+            with self._account_lock(name):
+                self._refresh_interest(self.accounts[name])
+                data[name] = self._account_data(self.accounts[name])
+                versions[name] = self.accounts[name].version
+        rules = self._rules_data()
+        chunk_size = -(-len(names) // (workers * 4))
+        payloads = [
+            {
+                'accounts': {name: data[name] for name in names[i:i + chunk_size]},
+                'rules': rules,
+            }
+            for i in range(0, len(names), chunk_size)
+        ]
+        results = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in pool.map(_statement_batch, payloads, [year_month] * len(payloads)):
+                for name, (result, posted) in batch.items():
+                    with self._account_lock(name):
+                        acc = self.accounts[name]
+                        if acc.version != versions[name]:
+                            # changed since it was copied, e.g. a concurrent statement posted
+                            # the same interest, so the worker's rows may repeat or be stale
+                            self._accrue_interest(acc, year_month)
+                            results[name] = self._render_statement(acc, *self._parse_year_month(year_month))
+                            continue
+                        for date_str, txn_id, amount in posted:
+                            txn = Transaction(date=parse_date(date_str), txn_id=txn_id, type='I', amount=amount)
+                            acc.add_transaction(txn)
+                            self._record(name, [txn])
+                    results[name] = result
+        return {name: results[name] for name in names}
+
     def to_dict(self) -> Dict:
-        data = {
-            'accounts': {
-                name: [
-                    {
-                        'date': t.date.strftime(TXN_DATE_FORMAT),
-                        'txn_id': t.txn_id,
-                        'type': t.type,
-                        'amount': t.amount,
-                    }
-                    for t in acc.transactions
-                ]
-                for name, acc in self.accounts.items()
-            },
-            'rules': [
-                {
-                    'date': r.date.strftime(TXN_DATE_FORMAT),
-                    'rule_id': r.rule_id,
-                    'rate': r.rate,
-                }
-                for r in self.rules
-            ],
-        }
+        data = {'accounts': {}}
+        # stale interest that has not been re-accrued yet
+        dirty_from = {}
+        with self._rules_lock.read():
+            for name in self._account_names():
+                acc = self._find_account(name)
+                with self._account_lock(name):
+                    data['accounts'][name] = self._account_data(acc)
+                    dirty = self._dirty_date(name)
+                    if dirty is not None and self._has_interest_from(acc, dirty):
+                        dirty_from[name] = dirty.strftime(TXN_DATE_FORMAT)
+            data['rules'] = self._rules_data()
+        if dirty_from:
+            data['dirty_from'] = dirty_from
         return data
 
     @classmethod
-    def from_dict(cls, data: Dict) -> 'Ledger':
-        ledger = cls()
+    def from_dict(cls, data: Dict, account_cls=Account) -> 'Ledger':
+        """bulk build, each account is constructed once from its full row list
+
+        persisted rows are already in (date, txn_id) order, so the constructor's
+        sort only has to confirm a single run and indexing is one pass
+        """
+        ledger = cls(account_cls=account_cls)
         for name, txns in data.get('accounts', {}).items():
-            acc = ledger._get_account(name)
-            for t in txns:
-                acc.add_transaction(
-                    Transaction(
-                        date=dt.datetime.strptime(t['date'], TXN_DATE_FORMAT).date(),
-                        txn_id=t['txn_id'],
-                        type=t['type'],
-                        amount=t['amount'],
-                    )
-                )
+            ledger.accounts[name] = account_cls(name, [
+                Transaction(date=parse_date(t['date']), txn_id=t['txn_id'], type=t['type'], amount=t['amount'])
+                for t in txns
+            ])
         for r in data.get('rules', []):
-            ledger.rules.append(
-                InterestRule(
-                    date=dt.datetime.strptime(r['date'], TXN_DATE_FORMAT).date(),
-                    rule_id=r['rule_id'],
-                    rate=r['rate'],
-                )
-            )
+            ledger.rules.append(InterestRule(date=parse_date(r['date']), rule_id=r['rule_id'], rate=r['rate']))
         ledger.rules.sort(key=lambda r: r.date)
+        ledger._timeline = None
+        for name, date_str in data.get('dirty_from', {}).items():
+            ledger._dirty_from[name] = parse_date(date_str)
         return ledger
+
+
+# worker functions ---------------------------------------------------------------------
+def _statement_batch(data: Dict, year_month: str) -> Dict[str, tuple]:
+    """render statements for a partition of accounts in a worker process
+
+    returns the statement and the interest rows posted by accrual per account
+    """
+    ledger = Ledger.from_dict(data)
+    results = {}
+    for name, acc in ledger.accounts.items():
+        before = {t.txn_id for t in acc.transactions if t.type == 'I'}
+        result = ledger.statement(name, year_month)
+        posted = [
+            (t.date.strftime(TXN_DATE_FORMAT), t.txn_id, t.amount)
+            for t in acc.transactions if t.type == 'I' and t.txn_id not in before
+        ]
+        results[name] = (result, posted)
+    return results
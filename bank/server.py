@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Asyncio ledger service over one warm in-memory ledger
+
+Clients send one JSON request per line, {"id": ..., "action": ..., "args": {...}},
+and receive one JSON response per line in the drive response shape with the
+request id echoed. Statements run concurrently in a thread pool on a snapshot
+of the account; mutations are applied in order by a single writer task that
+persists once per batch.
+"""
+# dependencies ----------------------------------------------------------------------
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from . import drive, state, stats
+
+
+# constants -------------------------------------------------------------------------
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+READ_WORKERS = 4
+MUTATIONS = ('transaction_add', 'rule_add', 'close_month')
+
+
+# classes ----------------------------------------------------------------------------
+class LedgerServer:
+    def __init__(self, ledger=None, read_workers: int = READ_WORKERS):
+        self.ledger = ledger if ledger is not None else drive.ledger
+        self.pool = ThreadPoolExecutor(max_workers=read_workers)
+        # every store write runs on this one thread, in batch order
+        self.persister = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ledger-persist')
+        self._unpersisted = []
+        self.queue: asyncio.Queue = None
+        self.server = None
+        self._writer_task = None
+        self._clients = set()
+
+    # --- lifecycle ---
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, path: str = None):
+        """listen on a unix socket when path is given, TCP otherwise"""
+        self.queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+        if path:
+            self.server = await asyncio.start_unix_server(self._client, path=path)
+        else:
+            self.server = await asyncio.start_server(self._client, host=host, port=port)
+        return self.server
+
+    async def stop(self) -> None:
+        self.server.close()
+        if self._clients:
+            await asyncio.gather(*self._clients, return_exceptions=True)
+        await self.server.wait_closed()
+        await self.queue.join()
+        self._writer_task.cancel()
+        self.pool.shutdown()
+        self.persister.shutdown()
+
+    # --- connections ---
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        tasks = set()
+        self._clients.add(asyncio.current_task())
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self._respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+            self._clients.discard(asyncio.current_task())
+
+    async def _respond(self, line: bytes, writer: asyncio.StreamWriter) -> None:
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            response = await self.handle(request.get('action'), request.get('args', {}))
+        except json.JSONDecodeError:
+            response = {'success': -1, 'error': 'Invalid JSON request'}
+        except Exception as e:
+            response = {'success': -1, 'error': str(e)}
+        writer.write((json.dumps({'id': request_id, **response}) + '\n').encode())
+        await writer.drain()
+
+    # --- actions ---
+    async def handle(self, action: str, args: dict) -> dict:
+        if action in MUTATIONS:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((action, args, future))
+            return await future
+        elif action == 'statement':
+            return await self._statement(**args)
+        elif action == 'stats':
+            return {'success': 1, **stats.snapshot()}
+        return {'success': -1, 'error': f'Unknown action {action}'}
+
+    async def _statement(self, account: str, year_month: str) -> dict:
+        # copy the account between writer batches, then accrue and render off-loop
+        snapshot = self.ledger.snapshot([account])
+        try:
+            with stats.timed('server.statement'):
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, snapshot.statement, account, year_month
+                )
+        except Exception as e:
+            return {'success': -1, 'error': str(e)}
+        return {'success': 1, **result}
+
+    def _apply(self, action: str, args: dict) -> (dict, dict):
+        """apply one mutation, returning the response and its journal record"""
+        try:
+            if action == 'transaction_add':
+                txn = self.ledger.add_transaction(args['date'], args['account'], args['t_type'], float(args['amount']))
+                record = {'op': 'T', 'date': args['date'], 'account': args['account'], 'type': args['t_type'],
+                          'amount': float(args['amount'])}
+                return {'success': 1, 'txn_id': txn.txn_id}, record
+            elif action == 'rule_add':
+                self.ledger.add_rule(args['date'], args['rule_id'], float(args['rate']))
+                record = {'op': 'R', 'date': args['date'], 'rule_id': args['rule_id'], 'rate': float(args['rate'])}
+                return {'success': 1}, record
+            else:
+                result = self.ledger.close_month(args['year_month'])
+                return {'success': 1, **result}, {'op': 'C', 'year_month': args['year_month']}
+        except Exception as e:
+            return {'success': -1, 'error': str(e)}, None
+
+    async def _writer(self) -> None:
+        # single writer: drain whatever is queued, apply in order, persist once
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            responses = []
+            records = []
+            with stats.timed('server.write_batch'):
+                for action, args, future in batch:
+                    response, record = self._apply(action, args)
+                    responses.append(response)
+                    if record is not None:
+                        records.append(record)
+                try:
+                    # mutations are paused while the batch is written, reads continue
+                    await asyncio.get_running_loop().run_in_executor(self.persister, self._persist, records)
+                except Exception as e:
+                    # the mutations are live and go out with the next batch's save
+                    stats.incr('server.persist_failed')
+                    responses = [
+                        {**response, 'persist_error': f'Persistence failed: {e}'} if response['success'] == 1 else response
+                        for response in responses
+                    ]
+            stats.incr('server.mutations', len(batch))
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+                self.queue.task_done()
+
+    def _persist(self, records: list) -> None:
+        # journal records of a failed save are retried ahead of the new ones
+        records = self._unpersisted + records
+        if not records:
+            return
+        try:
+            if state.BACKEND == 'json' and state.MODE == 'journal':
+                # the whole batch goes to the journal in one write and fsync
+                state.save(self.ledger, records=records)
+            else:
+                state.save(self.ledger)
+        except Exception:
+            self._unpersisted = records
+            raise
+        self._unpersisted = []
+
+
+# entry point ----------------------------------------------------------------------------
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, path: str = None) -> None:
+    server = await LedgerServer().start(host=host, port=port, path=path)
+    async with server:
+        await server.serve_forever()
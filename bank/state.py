@@ -1,28 +1,337 @@
 #!/usr/bin/env python3
 """CRUD operations to persist the ledger state to memory"""
 # dependencies ---------------------------------------------------------------------
+import atexit
 import json
+import os
+import threading
+import time
+from contextlib import ExitStack
 from pathlib import Path
+from . import stats
 from .ledger import Ledger
+from .storage import BinaryStore, ShardStore, SqliteStore
 
 
 # constants -------------------------------------------------------------------------
 STATE_FILE = 'state.json'
+JOURNAL_FILE = 'state.journal'
+SQLITE_FILE = 'state.db'
+SHARD_DIR = 'state_shards'
+BINARY_FILE = 'state.bin'
+ARCHIVE_FILE = 'state.archive'
+HISTORY_FILE = 'state.history'
+BACKEND = 'json'  # 'json', 'sqlite', 'shards' or 'binary'
+MODE = 'snapshot'  # 'snapshot' rewrites STATE_FILE, 'journal' appends to JOURNAL_FILE
+FSYNC = False  # fsync the journal after every append, once per batch of records
+COMPACT_EVERY = 1000  # journal records before folding into a new snapshot
+SAVE_POLICY = 'immediate'  # 'immediate', 'every' SAVE_EVERY mutations or 'interval' of SAVE_INTERVAL_MS
+SAVE_EVERY = 100
+SAVE_INTERVAL_MS = 1000
+
+
+# module variables  -----------------------------------------------------------------
+journal_seq = 0  # sequence number of the last record applied or written
+journal_count = 0  # records in the journal since the last snapshot
+_store = None
+_pending = None  # [ledger, journal records or None for a full write, mutations, first queued at]
+_autosave = None  # background writer thread
+_autosave_cond = threading.Condition()
+_save_lock = threading.Lock()  # held for every write so batches land in order
 
 
 # state functions -------------------------------------------------------------------
+@stats.timed('state.load')
 def load(state_override={}) -> Ledger:
+    global journal_seq, journal_count
+    # queued mutations of the previous ledger must reach disk before it is replaced
+    flush()
+    journal_seq = 0
+    journal_count = 0
     if state_override:
         return Ledger.from_dict(state_override)
-    elif STATE_FILE.exists():
-        data = json.loads(STATE_FILE.read_text())
-        return Ledger.from_dict(data)
-    return Ledger()
+    if BACKEND != 'json':
+        ledger = store().load()
+    else:
+        ledger = Ledger()
+        if STATE_FILE.exists():
+            data = json.loads(STATE_FILE.read_text())
+            ledger = Ledger.from_dict(data)
+            journal_seq = data.get('journal_seq', 0)
+        if JOURNAL_FILE.exists():
+            replay(ledger)
+    # replayed mutations are already in the history, which replaces what replay recorded
+    history_load(ledger)
+    return ledger
+
+
+@stats.timed('state.save')
+def save(ledger: Ledger, record: dict = None, records: list = None) -> None:
+    """persist a mutation now, or queue it for the autosave thread per SAVE_POLICY
+
+    record is the journal record of the mutation, records those of a batch of
+    mutations appended together; neither asks for a full write
+    """
+    global _pending
+    if records is None and record is not None:
+        records = [record]
+    if SAVE_POLICY == 'immediate':
+        with _save_lock:
+            _write(ledger, records)
+        return
+    with _autosave_cond:
+        if _pending is None:
+            _pending = [ledger, [], 0, time.monotonic()]
+        elif _pending[0] is not ledger:
+            # a different ledger replaces the stored one, write it in full
+            _pending = [ledger, None, 0, _pending[3]]
+        if records is None:
+            _pending[1] = None
+        elif _pending[1] is not None:
+            _pending[1].extend(records)
+        _pending[2] += len(records) if records else 1
+        stats.incr('state.saves_queued')
+        _autosave_cond.notify()
+    _start_autosave()
+
+
+def flush() -> None:
+    """write any queued mutations now"""
+    global _pending
+    with _save_lock:
+        with _autosave_cond:
+            pending, _pending = _pending, None
+        if pending is not None:
+            try:
+                with stats.timed('state.flush'):
+                    _write(pending[0], pending[1], locked=True)
+            except Exception:
+                _requeue(pending)
+                raise
+
+
+def _requeue(pending: list) -> None:
+    # a failed write goes back in front of anything queued meanwhile
+    global _pending
+    with _autosave_cond:
+        if _pending is None:
+            _pending = pending
+        elif _pending[0] is not pending[0]:
+            pass  # a different ledger was queued since, it is written in full
+        else:
+            if pending[1] is None or _pending[1] is None:
+                _pending[1] = None
+            else:
+                _pending[1] = pending[1] + _pending[1]
+            _pending[2] += pending[2]
+            _pending[3] = pending[3]
+
+
+def _write(ledger: Ledger, records: list, locked: bool = False) -> None:
+    # records None writes the full state, otherwise they are journaled when journaling
+    if BACKEND != 'json':
+        # stores already write only the changed accounts; off the mutating
+        # thread the accounts are held still while their rows are read
+        with ExitStack() as locks:
+            if locked:
+                locks.enter_context(ledger._rules_lock.read())
+                for name in sorted(ledger._account_names()):
+                    locks.enter_context(ledger._account_lock(name))
+            store().save(ledger)
+    elif MODE == 'journal' and records is not None:
+        append(*records)
+        if journal_count >= COMPACT_EVERY:
+            compact(ledger)
+    else:
+        compact(ledger)
+    # after the state, so the history never runs ahead of what a load restores
+    history_append(ledger)
+
+
+def _start_autosave() -> None:
+    global _autosave
+    if _autosave is None or not _autosave.is_alive():
+        _autosave = threading.Thread(target=_autosave_loop, name='state-autosave', daemon=True)
+        _autosave.start()
+
+
+def _due() -> float:
+    """seconds until the queued mutations are due, 0 when due, None when nothing is due"""
+    if _pending is None:
+        return None
+    if SAVE_POLICY == 'every':
+        return 0 if _pending[2] >= SAVE_EVERY else None
+    if SAVE_POLICY == 'interval':
+        return max(0.0, _pending[3] + SAVE_INTERVAL_MS / 1000 - time.monotonic())
+    return 0
+
+
+def _autosave_loop() -> None:
+    # one write per SAVE_EVERY mutations, or SAVE_INTERVAL_MS after the first unsaved one
+    while True:
+        with _autosave_cond:
+            while (wait := _due()) != 0:
+                _autosave_cond.wait(wait)
+        try:
+            flush()
+        except Exception:
+            # the batch was requeued, retry after a pause rather than spin
+            stats.incr('state.flush_failed')
+            time.sleep(SAVE_INTERVAL_MS / 1000)
+
+
+def store():
+    """storage backend instance for the configured BACKEND"""
+    global _store
+    if BACKEND == 'sqlite':
+        store_cls, path = SqliteStore, SQLITE_FILE
+    elif BACKEND == 'shards':
+        store_cls, path = ShardStore, SHARD_DIR
+    elif BACKEND == 'binary':
+        store_cls, path = BinaryStore, BINARY_FILE
+    else:
+        raise ValueError(f'Unknown storage backend {BACKEND}')
+    stale = not isinstance(_store, store_cls) or _store.path != path
+    if stale or not Path(path).exists():
+        if _store is not None:
+            _store.close()
+        _store = store_cls(path)
+    return _store
+
+
+# journal functions -----------------------------------------------------------------
+def append(*records: dict) -> None:
+    """append compact mutation records to the journal with one write and fsync"""
+    global journal_seq, journal_count
+    if not records:
+        return
+    lines = []
+    for record in records:
+        journal_seq += 1
+        lines.append(json.dumps({'seq': journal_seq, **record}, separators=(',', ':')) + '\n')
+    text = ''.join(lines)
+    with open(JOURNAL_FILE, 'a') as f:
+        f.write(text)
+        stats.incr('state.bytes_written', len(text))
+        if FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    journal_count += len(records)
+
+
+def compact(ledger: Ledger) -> None:
+    """write a full snapshot and discard the journal records it covers"""
+    global journal_count
+    data = ledger.to_dict()
+    data['journal_seq'] = journal_seq
+    text = json.dumps(data, indent=2)
+    # temp file + rename, a crash mid-write leaves the previous snapshot intact
+    tmp = STATE_FILE.with_name(STATE_FILE.name + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(text)
+        if FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, STATE_FILE)
+    stats.incr('state.bytes_written', len(text))
+    if JOURNAL_FILE.exists():
+        JOURNAL_FILE.unlink()
+    journal_count = 0
+
+
+def replay(ledger: Ledger) -> None:
+    global journal_seq, journal_count
+    with open(JOURNAL_FILE) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # torn write at the tail of the journal
+                break
+            if record['seq'] <= journal_seq:
+                # already folded into the snapshot
+                continue
+            apply(ledger, record)
+            journal_seq = record['seq']
+            journal_count += 1
+
+
+def apply(ledger: Ledger, record: dict) -> None:
+    op = record['op']
+    if op == 'T':
+        ledger.add_transaction(record['date'], record['account'], record['type'], record['amount'])
+    elif op == 'R':
+        ledger.add_rule(record['date'], record['rule_id'], record['rate'])
+    elif op == 'S':
+        ledger._accrue_interest(ledger.accounts[record['account']], record['year_month'])
+    elif op == 'C':
+        ledger.close_month(record['year_month'])
+    else:
+        raise ValueError(f'Unknown journal record {op}')
+
+
+# history functions -----------------------------------------------------------------
+def history_append(ledger: Ledger) -> None:
+    """append the ledger's mutation history recorded since the last append"""
+    entries, upto = ledger.history_entries()
+    if entries:
+        text = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries)
+        with open(HISTORY_FILE, 'a') as f:
+            f.write(text)
+            stats.incr('state.bytes_written', len(text))
+            if FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+    ledger.history_saved(upto)
+
+
+def history_load(ledger: Ledger) -> None:
+    """restore the mutation history, seqs and their times from HISTORY_FILE"""
+    entries = []
+    if HISTORY_FILE.exists():
+        with open(HISTORY_FILE) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # torn write at the tail of the history
+                    break
+    ledger.restore_history(entries)
+
+
+# archive functions -----------------------------------------------------------------
+def archive_append(archived: dict) -> None:
+    """append the rows folded by Ledger.archive to the cold archive, one line per account"""
+    if not archived:
+        return
+    with open(ARCHIVE_FILE, 'a') as f:
+        for name, rows in archived.items():
+            line = json.dumps({'account': name, 'rows': rows}, separators=(',', ':'))
+            f.write(line + '\n')
+            stats.incr('state.bytes_written', len(line) + 1)
+        f.flush()
+        os.fsync(f.fileno())
 
 
-def save(ledger: Ledger) -> None:
-    STATE_FILE.write_text(json.dumps(ledger.to_dict(), indent=2))
+def archive_rows(account: str) -> list:
+    """every archived row of the account in (date, txn_id) order"""
+    rows = {}
+    if ARCHIVE_FILE.exists():
+        with open(ARCHIVE_FILE) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['account'] == account:
+                    # keyed by txn id, rows appended again after a crash before the save are dropped
+                    rows.update((r['txn_id'], r) for r in record['rows'])
+    return sorted(rows.values(), key=lambda r: (r['date'], r['txn_id']))
 
 
 # load -----------------------------------------------------------------------------
+atexit.register(flush)
 STATE_FILE = Path(__file__).resolve().parent.parent / 'state.json'
+JOURNAL_FILE = Path(__file__).resolve().parent.parent / 'state.journal'
+SQLITE_FILE = Path(__file__).resolve().parent.parent / 'state.db'
+SHARD_DIR = Path(__file__).resolve().parent.parent / 'state_shards'
+BINARY_FILE = Path(__file__).resolve().parent.parent / 'state.bin'
+ARCHIVE_FILE = Path(__file__).resolve().parent.parent / 'state.archive'
+HISTORY_FILE = Path(__file__).resolve().parent.parent / 'state.history'
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Low-overhead counters and latency histograms for the hot paths"""
+# dependencies ---------------------------------------------------------------------
+import bisect
+import json
+import time
+from contextlib import ContextDecorator
+from pathlib import Path
+from typing import Dict
+
+
+# constants -------------------------------------------------------------------------
+LATENCY_BUCKETS_MS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+# module variables  -----------------------------------------------------------------
+ENABLED = True
+counters: Dict[str, int] = {}
+histograms: Dict[str, 'Histogram'] = {}
+
+
+# classes ----------------------------------------------------------------------------
+class Histogram:
+    """latency histogram over fixed millisecond buckets, the last bucket is overflow"""
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float) -> None:
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def to_dict(self) -> Dict:
+        labels = [f'<={b}' for b in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}']
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'buckets_ms': dict(zip(labels, self.buckets)),
+        }
+
+
+class timed(ContextDecorator):
+    """record the wall time of a block or function call in the named histogram"""
+    def __init__(self, name: str):
+        self.name = name
+
+    def _recreate_cm(self):
+        # a fresh instance per decorated call so concurrent calls keep their own start
+        return type(self)(self.name)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if ENABLED:
+            observe(self.name, (time.perf_counter() - self._start) * 1000)
+        return False
+
+
+# functions --------------------------------------------------------------------------
+def incr(name: str, n: int = 1) -> None:
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + n
+
+
+def observe(name: str, ms: float) -> None:
+    if name not in histograms:
+        histograms[name] = Histogram()
+    histograms[name].observe(ms)
+
+
+def snapshot() -> Dict:
+    return {
+        'counters': dict(sorted(counters.items())),
+        'latency': {name: h.to_dict() for name, h in sorted(histograms.items())},
+    }
+
+
+def reset() -> None:
+    counters.clear()
+    histograms.clear()
+
+
+def report() -> str:
+    """plain text view of the counters and latencies"""
+    lines = ['| Counter                        |        Value |']
+    for name, value in sorted(counters.items()):
+        lines.append(f'| {name:<30} | {value:>12} |')
+    lines.append('| Timer                          | Count |  Mean ms |   Max ms |')
+    for name, h in sorted(histograms.items()):
+        data = h.to_dict()
+        lines.append(f"| {name:<30} | {data['count']:>5} | {data['mean_ms']:8.3f} | {data['max_ms']:8.3f} |")
+    return '\n'.join(lines)
+
+
+def dump(path) -> None:
+    Path(path).write_text(json.dumps(snapshot(), indent=2))
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""Storage backends that load accounts on demand"""
+# dependencies ---------------------------------------------------------------------
+import datetime as dt
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, List, Set
+from urllib.parse import quote
+from . import stats
+from .ledger import Account, AccountMap, InterestRule, Ledger, Transaction, TXN_DATE_FORMAT, parse_date
+
+
+# constants -------------------------------------------------------------------------
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    name TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS transactions (
+    account TEXT NOT NULL,
+    date TEXT NOT NULL,
+    txn_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (account, date, txn_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rules (
+    date TEXT PRIMARY KEY,
+    rule_id TEXT NOT NULL,
+    rate REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dirty (
+    account TEXT PRIMARY KEY,
+    date TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rule_changes (
+    position INTEGER PRIMARY KEY,
+    date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rules_seen (
+    account TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+BINARY_MAGIC = b'GICB'
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct('<4sHIIIIIQ')  # magic, version, accounts, rules, dirty, rule changes, seen, table offset
+BINARY_RECORD = struct.Struct('<iHcd')  # date ordinal, txn id sequence, type, amount
+BINARY_RULE = struct.Struct('<id')  # date ordinal, rate
+BINARY_INTEREST_SEQ = 0xFFFF  # sequence of the '-I' txn id
+BINARY_CHECKPOINT_SEQ = 0xFFFE  # sequence of the '-B' carry-forward txn id
+
+
+# classes ------------------------------------------------------------------------------
+class Store:
+    """base class for stores that load accounts on demand
+
+    subclasses implement names(), load_account(name), load_rules(),
+    load_reaccrual() and write(changed, rules, reaccrual, full); accounts are
+    tracked by Account.version so save only writes what changed since the
+    account was loaded or saved. reaccrual holds the dirty dates that leave
+    posted interest stale, the rule change log and how many of its entries
+    each account has seen, so a reload restates the same months while the
+    data written scales with the accounts touched
+    """
+    def __init__(self, path):
+        self.path = path
+        self._ledger = None
+        self._saved_versions: Dict[str, int] = {}
+
+    def load(self) -> Ledger:
+        ledger = Ledger()
+        ledger.accounts = AccountMap(self)
+        ledger.rules = self.load_rules()
+        reaccrual = self.load_reaccrual()
+        ledger._dirty_from.update(reaccrual['dirty_from'])
+        ledger._rule_changes = list(reaccrual['rule_changes'])
+        ledger._rules_seen.update(reaccrual['rules_seen'])
+        self._ledger = ledger
+        return ledger
+
+    def save(self, ledger: Ledger) -> None:
+        # another ledger over this store writes what it has loaded; any other
+        # ledger replaces the stored book, so every one of its accounts is written
+        lazy = isinstance(ledger.accounts, AccountMap) and ledger.accounts.store is self
+        full = ledger is not self._ledger and not lazy
+        if ledger is not self._ledger:
+            self._saved_versions = {}
+            self._ledger = ledger
+        if lazy:
+            accounts = ledger.accounts.loaded
+        else:
+            accounts = {name: ledger.accounts[name] for name in ledger.accounts}
+        changed = {
+            name: acc for name, acc in accounts.items()
+            if self._saved_versions.get(name) != acc.version
+        }
+        self.write(changed, ledger.rules, self._reaccrual(ledger, accounts), full)
+        for name, acc in changed.items():
+            self._saved_versions[name] = acc.version
+
+    @staticmethod
+    def _reaccrual(ledger: Ledger, loaded: Dict[str, Account]) -> Dict:
+        dirty = {}
+        for name, date in list(ledger._dirty_from.items()):
+            acc = loaded.get(name)
+            # an account not loaded keeps the date it was stored with
+            if acc is None or ledger._has_interest_from(acc, date):
+                dirty[name] = date
+        return {
+            'dirty_from': dirty,
+            'rule_changes': list(ledger._rule_changes),
+            'rules_seen': {name: count for name, count in ledger._rules_seen.items() if count},
+        }
+
+    @staticmethod
+    def _reaccrual_data(reaccrual: Dict) -> Dict:
+        return {
+            'dirty_from': {name: date.strftime(TXN_DATE_FORMAT) for name, date in reaccrual['dirty_from'].items()},
+            'rule_changes': [date.strftime(TXN_DATE_FORMAT) for date in reaccrual['rule_changes']],
+            'rules_seen': dict(reaccrual['rules_seen']),
+        }
+
+    @staticmethod
+    def _reaccrual_from_data(data: Dict) -> Dict:
+        return {
+            'dirty_from': {name: parse_date(date) for name, date in data.get('dirty_from', {}).items()},
+            'rule_changes': [parse_date(date) for date in data.get('rule_changes', [])],
+            'rules_seen': dict(data.get('rules_seen', {})),
+        }
+
+    def _loaded(self, acc: Account) -> Account:
+        self._saved_versions[acc.name] = acc.version
+        return acc
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteStore(Store):
+    """ledger storage in SQLite, transactions indexed on (account, date, txn_id)
+
+    accounts are read one at a time with an indexed range query when the ledger
+    first touches them; startup lists them from the small accounts table. the
+    connection is shared by the mutating threads and the autosave thread, one
+    statement or write transaction at a time under _lock
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.executescript(SQLITE_SCHEMA)
+        with self.conn:
+            # databases written before the accounts table existed
+            if self.conn.execute('SELECT 1 FROM accounts LIMIT 1').fetchone() is None:
+                self.conn.execute('INSERT INTO accounts (name) SELECT DISTINCT account FROM transactions')
+        self._saved_dirty: Dict[str, dt.date] = {}
+        self._saved_changes: List[dt.date] = []
+        self._saved_seen: Dict[str, int] = {}
+
+    # --- reads ---
+    def names(self) -> Set[str]:
+        with self._lock:
+            return {row[0] for row in self.conn.execute('SELECT name FROM accounts')}
+
+    def load_account(self, name: str) -> Account:
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT date, txn_id, type, amount FROM transactions WHERE account = ? ORDER BY date, txn_id',
+                (name,),
+            ).fetchall()
+        return self._loaded(Account(name, [
+            Transaction(
+                date=parse_date(date),
+                txn_id=txn_id,
+                type=t_type,
+                amount=amount,
+            )
+            for date, txn_id, t_type, amount in rows
+        ]))
+
+    def load_rules(self) -> List[InterestRule]:
+        with self._lock:
+            rows = self.conn.execute('SELECT date, rule_id, rate FROM rules ORDER BY date').fetchall()
+        return [
+            InterestRule(
+                date=parse_date(date),
+                rule_id=rule_id,
+                rate=rate,
+            )
+            for date, rule_id, rate in rows
+        ]
+
+    def load_reaccrual(self) -> Dict:
+        with self._lock:
+            dirty = self.conn.execute('SELECT account, date FROM dirty').fetchall()
+            changes = self.conn.execute('SELECT date FROM rule_changes ORDER BY position').fetchall()
+            seen = self.conn.execute('SELECT account, count FROM rules_seen').fetchall()
+        self._saved_dirty = {name: parse_date(date) for name, date in dirty}
+        self._saved_changes = [parse_date(date) for (date,) in changes]
+        self._saved_seen = dict(seen)
+        return {
+            'dirty_from': dict(self._saved_dirty),
+            'rule_changes': list(self._saved_changes),
+            'rules_seen': dict(self._saved_seen),
+        }
+
+    # --- writes ---
+    def write(self, changed: Dict[str, Account], rules: List[InterestRule], reaccrual: Dict, full: bool) -> None:
+        with self._lock, self.conn:
+            if full:
+                self.conn.execute('DELETE FROM accounts')
+                self.conn.execute('DELETE FROM transactions')
+            self.conn.executemany('INSERT OR IGNORE INTO accounts (name) VALUES (?)', [(name,) for name in changed])
+            for name, acc in changed.items():
+                # rows folded by checkpoint() or unposted interest must not survive
+                self.conn.execute('DELETE FROM transactions WHERE account = ?', (name,))
+                self.conn.executemany(
+                    'INSERT INTO transactions (account, date, txn_id, type, amount) VALUES (?, ?, ?, ?, ?)',
+                    [
+                        (name, t.date.strftime(TXN_DATE_FORMAT), t.txn_id, t.type, t.amount)
+                        for t in acc.transactions
+                    ],
+                )
+            self.conn.execute('DELETE FROM rules')
+            self.conn.executemany(
+                'INSERT INTO rules (date, rule_id, rate) VALUES (?, ?, ?)',
+                [(r.date.strftime(TXN_DATE_FORMAT), r.rule_id, r.rate) for r in rules],
+            )
+            # re-accrual state is written as a diff against what is stored
+            dirty, changes, seen = reaccrual['dirty_from'], reaccrual['rule_changes'], reaccrual['rules_seen']
+            if dirty != self._saved_dirty:
+                self.conn.executemany(
+                    'DELETE FROM dirty WHERE account = ?',
+                    [(name,) for name in self._saved_dirty if name not in dirty],
+                )
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO dirty (account, date) VALUES (?, ?)',
+                    [
+                        (name, date.strftime(TXN_DATE_FORMAT)) for name, date in dirty.items()
+                        if self._saved_dirty.get(name) != date
+                    ],
+                )
+            if changes != self._saved_changes:
+                self.conn.execute('DELETE FROM rule_changes')
+                self.conn.executemany(
+                    'INSERT INTO rule_changes (position, date) VALUES (?, ?)',
+                    [(i, date.strftime(TXN_DATE_FORMAT)) for i, date in enumerate(changes)],
+                )
+            if seen != self._saved_seen:
+                self.conn.executemany(
+                    'DELETE FROM rules_seen WHERE account = ?',
+                    [(name,) for name in self._saved_seen if name not in seen],
+                )
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO rules_seen (account, count) VALUES (?, ?)',
+                    [(name, count) for name, count in seen.items() if self._saved_seen.get(name) != count],
+                )
+        self._saved_dirty, self._saved_changes, self._saved_seen = dirty, changes, seen
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class ShardStore(Store):
+    """ledger storage as one JSON shard per account plus small manifest and rules files
+
+    <path>/manifest.json maps account names to shard files under <path>/accounts/;
+    pending re-accrual state is kept in <path>/dirty.json
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.dir = Path(path)
+        (self.dir / 'accounts').mkdir(parents=True, exist_ok=True)
+        self.manifest_file = self.dir / 'manifest.json'
+        self.rules_file = self.dir / 'rules.json'
+        self.dirty_file = self.dir / 'dirty.json'
+        self._manifest: Dict[str, str] = {}
+        if self.manifest_file.exists():
+            self._manifest = json.loads(self.manifest_file.read_text())['accounts']
+        self._saved_rules = None
+        self._saved_dirty = {}
+
+    # --- reads ---
+    def names(self) -> Set[str]:
+        return set(self._manifest)
+
+    def load_account(self, name: str) -> Account:
+        txns = json.loads((self.dir / 'accounts' / self._manifest[name]).read_text())
+        return self._loaded(Account(name, [
+            Transaction(
+                date=parse_date(t['date']),
+                txn_id=t['txn_id'],
+                type=t['type'],
+                amount=t['amount'],
+            )
+            for t in txns
+        ]))
+
+    def load_rules(self) -> List[InterestRule]:
+        if not self.rules_file.exists():
+            return []
+        data = json.loads(self.rules_file.read_text())
+        self._saved_rules = data
+        return [
+            InterestRule(
+                date=parse_date(r['date']),
+                rule_id=r['rule_id'],
+                rate=r['rate'],
+            )
+            for r in data
+        ]
+
+    def load_reaccrual(self) -> Dict:
+        if self.dirty_file.exists():
+            self._saved_dirty = json.loads(self.dirty_file.read_text())
+        return self._reaccrual_from_data(self._saved_dirty)
+
+    # --- writes ---
+    def write(self, changed: Dict[str, Account], rules: List[InterestRule], reaccrual: Dict, full: bool) -> None:
+        manifest_changed = False
+        if full:
+            for shard in (self.dir / 'accounts').iterdir():
+                shard.unlink()
+            self._manifest = {}
+            manifest_changed = True
+        for name, acc in changed.items():
+            if name not in self._manifest:
+                self._manifest[name] = quote(name, safe='') + '.json'
+                manifest_changed = True
+            txns = [
+                {
+                    'date': t.date.strftime(TXN_DATE_FORMAT),
+                    'txn_id': t.txn_id,
+                    'type': t.type,
+                    'amount': t.amount,
+                }
+                for t in acc.transactions
+            ]
+            text = json.dumps(txns)
+            (self.dir / 'accounts' / self._manifest[name]).write_text(text)
+            stats.incr('state.bytes_written', len(text))
+        if manifest_changed:
+            self.manifest_file.write_text(json.dumps({'accounts': self._manifest}, indent=2))
+        rules_data = [
+            {'date': r.date.strftime(TXN_DATE_FORMAT), 'rule_id': r.rule_id, 'rate': r.rate}
+            for r in rules
+        ]
+        if rules_data != self._saved_rules:
+            self.rules_file.write_text(json.dumps(rules_data, indent=2))
+            self._saved_rules = rules_data
+        dirty_data = self._reaccrual_data(reaccrual)
+        if dirty_data != self._saved_dirty:
+            self.dirty_file.write_text(json.dumps(dirty_data, indent=2))
+            self._saved_dirty = dirty_data
+
+
+class BinaryStore(Store):
+    """ledger snapshot in a fixed-width binary layout, read through mmap
+
+    layout: header, rules, re-accrual state (dirty-from dates, rule change
+    dates, per-account rule changes seen), then per account a run of
+    fixed-width records (date ordinal, txn id sequence, type, amount), and an
+    account table of (name, offset, count) located by the header. Opening
+    reads only the header and tables; records are decoded per account on
+    first access, without any date or number string parsing. On save the
+    records of unchanged accounts are copied across as raw bytes
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self._file = None
+        self._map = None
+        self._table: Dict[str, tuple] = {}
+        self._rules: List[InterestRule] = []
+        self._saved_reaccrual: Dict = {'dirty_from': {}, 'rule_changes': [], 'rules_seen': {}}
+        self._dates: Dict[int, tuple] = {}
+        if Path(path).exists() and Path(path).stat().st_size:
+            self._open()
+
+    # --- encoding helpers ---
+    @staticmethod
+    def _pack_str(value: str) -> bytes:
+        data = value.encode()
+        return struct.pack('<H', len(data)) + data
+
+    def _unpack_str(self, pos: int) -> (str, int):
+        (size,) = struct.unpack_from('<H', self._map, pos)
+        pos += 2
+        return self._map[pos:pos + size].decode(), pos + size
+
+    def _date(self, ordinal: int) -> tuple:
+        # (date, 'YYYYMMDD') cached per ordinal, dates repeat heavily
+        if ordinal not in self._dates:
+            date = dt.date.fromordinal(ordinal)
+            self._dates[ordinal] = (date, date.strftime(TXN_DATE_FORMAT))
+        return self._dates[ordinal]
+
+    @staticmethod
+    def _encode(t: Transaction) -> bytes:
+        date_str = t.date.strftime(TXN_DATE_FORMAT)
+        prefix, _, suffix = t.txn_id.rpartition('-')
+        if suffix == 'I':
+            seq = BINARY_INTEREST_SEQ
+        elif suffix == 'B':
+            seq = BINARY_CHECKPOINT_SEQ
+        elif suffix.isdigit() and t.txn_id == f'{date_str}-{int(suffix):02d}':
+            seq = int(suffix)
+        else:
+            raise ValueError(f'Txn id {t.txn_id} cannot be stored in the binary format')
+        if prefix != date_str:
+            raise ValueError(f'Txn id {t.txn_id} does not match its date')
+        return BINARY_RECORD.pack(t.date.toordinal(), seq, t.type.encode(), t.amount)
+
+    # --- reads ---
+    def _open(self) -> None:
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, n_accounts, n_rules, n_dirty, n_changes, n_seen,
+         table_offset) = BINARY_HEADER.unpack_from(self._map, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f'{self.path} is not a version {BINARY_VERSION} binary snapshot')
+        pos = BINARY_HEADER.size
+        self._rules = []
+        for _ in range(n_rules):
+            ordinal, rate = BINARY_RULE.unpack_from(self._map, pos)
+            rule_id, pos = self._unpack_str(pos + BINARY_RULE.size)
+            self._rules.append(InterestRule(date=self._date(ordinal)[0], rule_id=rule_id, rate=rate))
+        dirty = {}
+        for _ in range(n_dirty):
+            name, pos = self._unpack_str(pos)
+            (ordinal,) = struct.unpack_from('<i', self._map, pos)
+            pos += 4
+            dirty[name] = self._date(ordinal)[0]
+        changes = [self._date(ordinal)[0] for ordinal in struct.unpack_from(f'<{n_changes}i', self._map, pos)]
+        pos += 4 * n_changes
+        seen = {}
+        for _ in range(n_seen):
+            name, pos = self._unpack_str(pos)
+            (seen[name],) = struct.unpack_from('<I', self._map, pos)
+            pos += 4
+        self._saved_reaccrual = {'dirty_from': dirty, 'rule_changes': changes, 'rules_seen': seen}
+        self._table = {}
+        pos = table_offset
+        for _ in range(n_accounts):
+            name, pos = self._unpack_str(pos)
+            self._table[name] = struct.unpack_from('<QI', self._map, pos)
+            pos += 12
+
+    def _close_map(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+    def names(self) -> Set[str]:
+        return set(self._table)
+
+    def load_account(self, name: str) -> Account:
+        offset, count = self._table[name]
+        txns = []
+        view = memoryview(self._map)[offset:offset + count * BINARY_RECORD.size]
+        try:
+            for ordinal, seq, t_type, amount in BINARY_RECORD.iter_unpack(view):
+                date, date_str = self._date(ordinal)
+                if seq == BINARY_INTEREST_SEQ:
+                    suffix = 'I'
+                elif seq == BINARY_CHECKPOINT_SEQ:
+                    suffix = 'B'
+                else:
+                    suffix = f'{seq:02d}'
+                txns.append(Transaction(date=date, txn_id=f'{date_str}-{suffix}', type=t_type.decode(), amount=amount))
+        finally:
+            view.release()
+        return self._loaded(Account(name, txns))
+
+    def load_rules(self) -> List[InterestRule]:
+        return list(self._rules)
+
+    def load_reaccrual(self) -> Dict:
+        return {key: value.copy() for key, value in self._saved_reaccrual.items()}
+
+    # --- writes ---
+    def write(self, changed: Dict[str, Account], rules: List[InterestRule], reaccrual: Dict, full: bool) -> None:
+        ledger = self._ledger
+        if isinstance(ledger.accounts, AccountMap):
+            names = list(ledger.accounts)
+        else:
+            names = list(ledger.accounts.keys())
+        tmp_path = Path(str(self.path) + '.tmp')
+        table = []
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\0' * BINARY_HEADER.size)
+            for r in rules:
+                f.write(BINARY_RULE.pack(r.date.toordinal(), r.rate) + self._pack_str(r.rule_id))
+            dirty, changes, seen = reaccrual['dirty_from'], reaccrual['rule_changes'], reaccrual['rules_seen']
+            for name, date in dirty.items():
+                f.write(self._pack_str(name) + struct.pack('<i', date.toordinal()))
+            f.write(struct.pack(f'<{len(changes)}i', *(date.toordinal() for date in changes)))
+            for name, count in seen.items():
+                f.write(self._pack_str(name) + struct.pack('<I', count))
+            for name in names:
+                offset = f.tell()
+                if name in changed or full or name not in self._table:
+                    acc = changed.get(name) or ledger.accounts[name]
+                    data = b''.join(self._encode(t) for t in acc.transactions)
+                    count = len(acc.transactions)
+                else:
+                    # unchanged since it was written, copy the raw records
+                    old_offset, count = self._table[name]
+                    data = self._map[old_offset:old_offset + count * BINARY_RECORD.size]
+                f.write(data)
+                table.append((name, offset, count))
+            table_offset = f.tell()
+            for name, offset, count in table:
+                f.write(self._pack_str(name) + struct.pack('<QI', offset, count))
+            size = f.tell()
+            f.seek(0)
+            f.write(BINARY_HEADER.pack(
+                BINARY_MAGIC, BINARY_VERSION, len(table), len(rules), len(dirty), len(changes), len(seen), table_offset,
+            ))
+        self._close_map()
+        os.replace(tmp_path, self.path)
+        stats.incr('state.bytes_written', size)
+        self._open()
+
+    def close(self) -> None:
+        self._close_map()
+
+
+# conversion functions ---------------------------------------------------------------
+def json_to_binary(json_path, binary_path) -> None:
+    """convert a JSON state file into a binary snapshot"""
+    ledger = Ledger.from_dict(json.loads(Path(json_path).read_text()))
+    store = BinaryStore(binary_path)
+    store.save(ledger)
+    store.close()
+
+
+def binary_to_json(binary_path, json_path) -> None:
+    """convert a binary snapshot into a JSON state file"""
+    store = BinaryStore(binary_path)
+    data = store.load().to_dict()
+    store.close()
+    Path(json_path).write_text(json.dumps(data, indent=2))
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 """Simple banking CLI using ledger module."""
 # dependencies ----------------------------------------------------------------------
-from . import drive
+import argparse
+import asyncio
+import atexit
+import csv
+import json
+import sys
+from . import drive, server, stats
 
 DEFAULT_STATE = {
   "accounts": {
@@ -39,13 +45,12 @@ class BankApp:
     def __init__(self, input_fn=input, output_fn=print):
         self.input_fn = input_fn
         self.output_fn = output_fn
-        drive.state_refresh(state_override=DEFAULT_STATE)
 
     def run(self):
         drive.state_refresh(state_override=DEFAULT_STATE)
         self.output_fn("Welcome to AwesomeGIC Bank! What would you like to do?")
         while True:
-            self.output_fn("[T] Input transactions\n[I] Define interest rules\n[P] Print statement\n[Q] Quit")
+            self.output_fn("[T] Input transactions\n[I] Define interest rules\n[P] Print statement\n[S] Stats\n[Q] Quit")
             choice = self.input_fn("> ").strip().lower()
             if choice == 't':
                 self._input_transactions()
@@ -53,7 +58,10 @@ class BankApp:
                 self._define_interest_rules()
             elif choice == 'p':
                 self._print_statement()
+            elif choice == 's':
+                self.output_fn(stats.report())
             elif choice == 'q':
+                drive.state_flush()
                 self.output_fn("Thank you for banking with AwesomeGIC Bank.\nHave a nice day!")
                 break
             else:
@@ -112,8 +120,127 @@ class BankApp:
                 self.output_fn(response['error'])
 
 
+class BatchApp:
+    """non-interactive commands for feeds and scripts"""
+    def __init__(self, output_fn=print):
+        self.output_fn = output_fn
+
+    @staticmethod
+    def _read_rows(f):
+        for fields in csv.reader(f):
+            fields = [x.strip() for x in fields]
+            if not any(fields):
+                continue
+            if fields[0].lower() == 'date':
+                # header row
+                continue
+            yield fields
+
+    def import_transactions(self, path: str) -> int:
+        if path == '-':
+            response = drive.transactions_import(self._read_rows(sys.stdin))
+        else:
+            with open(path, newline='') as f:
+                response = drive.transactions_import(self._read_rows(f))
+        for error in response['errors']:
+            self.output_fn(f"row {error['row']}: {error['error']}")
+        if response['success'] != 1:
+            self.output_fn(response['error'])
+        self.output_fn(f"Imported {response['imported']} transactions with {len(response['errors'])} errors")
+        return 0 if response['success'] == 1 and not response['errors'] else 1
+
+    def statements(self, year_month: str, workers: int = 1, out_dir: str = None) -> int:
+        response = drive.statements_for_month(year_month, workers=workers, out_dir=out_dir)
+        if response['success'] != 1:
+            self.output_fn(response['error'])
+            return 1
+        if out_dir is None:
+            for result in response['statements'].values():
+                self.output_fn(result['statement'] + '\n')
+        else:
+            self.output_fn(f"Wrote {len(response['statements'])} statements to {out_dir}")
+        return 0
+
+    def simulate(self, path: str, from_year_month: str, to_year_month: str, accounts: bool = False) -> int:
+        with open(path) as f:
+            schedules = json.load(f)
+        response = drive.simulate_rules(schedules, from_year_month, to_year_month)
+        if response['success'] != 1:
+            self.output_fn(response['error'])
+            return 1
+        for scenario, result in response['scenarios'].items():
+            self.output_fn(f"{scenario}: {result['total']:.2f}")
+            if accounts:
+                for name, interest in result['accounts'].items():
+                    self.output_fn(f"  {name}: {interest:.2f}")
+        return 0
+
+    def archive(self, year_month: str) -> int:
+        response = drive.archive(year_month)
+        if response['success'] != 1:
+            self.output_fn(response['error'])
+            return 1
+        self.output_fn(f"Archived {response['archived']} transactions from {response['accounts']} accounts")
+        return 0
+
+    def statement_range(self, account: str, from_year_month: str, to_year_month: str, out_path: str = None) -> int:
+        response = drive.statement_range(account, from_year_month, to_year_month, out_path=out_path)
+        if response['success'] != 1:
+            self.output_fn(response['error'])
+            return 1
+        if out_path is None:
+            self.output_fn(response['statement'])
+        else:
+            self.output_fn(f"Wrote {response['lines']} lines to {out_path}")
+        return 0
+
+
 # entry point ----------------------------------------------------------------------------
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gicbank', description='AwesomeGIC Bank')
+    parser.add_argument('--stats-file', help='write counters and latencies as JSON on exit')
+    commands = parser.add_subparsers(dest='command')
+    import_parser = commands.add_parser('import', help='import transactions from a CSV file')
+    import_parser.add_argument(
+        'file', nargs='?', default='-',
+        help='CSV rows of <Date>,<Account>,<Type>,<Amount>, or - for stdin (default)',
+    )
+    statements_parser = commands.add_parser('statements', help='print statements for all accounts')
+    statements_parser.add_argument('year_month', help='<Year><Month>')
+    statements_parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    statements_parser.add_argument('--out-dir', help='write one file per account instead of stdout')
+    range_parser = commands.add_parser('statement-range', help='print one account over a range of months')
+    range_parser.add_argument('account')
+    range_parser.add_argument('from_year_month', help='first <Year><Month>')
+    range_parser.add_argument('to_year_month', help='last <Year><Month>')
+    range_parser.add_argument('--out', help='stream to this file instead of stdout')
+    simulate_parser = commands.add_parser('simulate', help='interest candidate rule schedules would have paid')
+    simulate_parser.add_argument('file', help='JSON object of scenario name to [{"date", "rule_id", "rate"}, ...]')
+    simulate_parser.add_argument('from_year_month', help='first <Year><Month>')
+    simulate_parser.add_argument('to_year_month', help='last <Year><Month>')
+    simulate_parser.add_argument('--accounts', action='store_true', help='also print the interest per account')
+    archive_parser = commands.add_parser('archive', help='move months up to a cutoff to the cold archive')
+    archive_parser.add_argument('year_month', help='last <Year><Month> to archive')
+    serve_parser = commands.add_parser('serve', help='serve the ledger over a local socket')
+    serve_parser.add_argument('--host', default=server.DEFAULT_HOST)
+    serve_parser.add_argument('--port', type=int, default=server.DEFAULT_PORT)
+    serve_parser.add_argument('--socket', help='unix socket path instead of TCP')
+    args = parser.parse_args(argv)
+    if args.stats_file:
+        atexit.register(stats.dump, args.stats_file)
+    if args.command == 'import':
+        sys.exit(BatchApp().import_transactions(args.file))
+    elif args.command == 'statements':
+        sys.exit(BatchApp().statements(args.year_month, workers=args.workers, out_dir=args.out_dir))
+    elif args.command == 'statement-range':
+        sys.exit(BatchApp().statement_range(args.account, args.from_year_month, args.to_year_month, out_path=args.out))
+    elif args.command == 'simulate':
+        sys.exit(BatchApp().simulate(args.file, args.from_year_month, args.to_year_month, accounts=args.accounts))
+    elif args.command == 'archive':
+        sys.exit(BatchApp().archive(args.year_month))
+    elif args.command == 'serve':
+        asyncio.run(server.serve(host=args.host, port=args.port, path=args.socket))
+        return
     BankApp().run()
 
 
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Benchmarks for the ledger hot paths on synthetic data
+
+usage:
+    python benchmarks.py --sizes small,medium --output bench.json
+    python benchmarks.py --baseline bench.json --tolerance 0.25
+"""
+# dependencies ---------------------------------------------------------------------------------------
+import argparse
+import datetime as dt
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from bank import state
+from bank.ledger import Ledger, TXN_DATE_FORMAT
+
+
+# constants ------------------------------------------------------------------------------------------
+SEED = 20230601
+START_DATE = dt.date(2021, 1, 1)
+SIZES = {
+    'small': {'accounts': 10, 'years': 1, 'txns_per_day': 0.5, 'rule_changes': 4},
+    'medium': {'accounts': 100, 'years': 2, 'txns_per_day': 0.5, 'rule_changes': 6},
+    'large': {'accounts': 1000, 'years': 3, 'txns_per_day': 0.5, 'rule_changes': 12},
+}
+REPEAT = 3
+ADD_TRANSACTIONS = 1000
+
+
+# data generator -------------------------------------------------------------------------------------
+def generate_ledger(accounts: int, years: int, txns_per_day: float, rule_changes: int, seed: int = SEED) -> dict:
+    """seeded synthetic ledger in Ledger.to_dict format
+
+    each account gets on average txns_per_day deposits/withdrawals per day over
+    the given number of years, and rule_changes interest rule changes per year
+    """
+    rnd = random.Random(seed)
+    days = (dt.date(START_DATE.year + years, 1, 1) - START_DATE).days
+    data = {'accounts': {}, 'rules': []}
+    for a in range(accounts):
+        txns = []
+        balance = 0.0
+        for d in range(days):
+            date = START_DATE + dt.timedelta(days=d)
+            count = int(txns_per_day) + (rnd.random() < txns_per_day % 1)
+            for n in range(1, count + 1):
+                amount = round(rnd.uniform(1, 500), 2)
+                t_type = 'W' if balance > amount and rnd.random() < 0.4 else 'D'
+                balance += amount if t_type == 'D' else -amount
+                date_str = date.strftime(TXN_DATE_FORMAT)
+                txns.append({'date': date_str, 'txn_id': f'{date_str}-{n:02d}', 'type': t_type, 'amount': amount})
+        data['accounts'][f'AC{a:06d}'] = txns
+    rule_days = sorted(rnd.sample(range(1, days), min(days - 1, rule_changes * years)))
+    for i, d in enumerate([0] + rule_days):
+        data['rules'].append({
+            'date': (START_DATE + dt.timedelta(days=d)).strftime(TXN_DATE_FORMAT),
+            'rule_id': f'RULE{i:03d}',
+            'rate': round(rnd.uniform(0.5, 5.0), 2),
+        })
+    return data
+
+
+# benchmarks -----------------------------------------------------------------------------------------
+def _time(fn, setup=None, repeat: int = REPEAT) -> float:
+    """best wall time in seconds over repeat runs, setup is not timed"""
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_size(size: dict, seed: int = SEED, repeat: int = REPEAT) -> dict:
+    data = generate_ledger(seed=seed, **size)
+    ledger = Ledger.from_dict(data)
+    # the busiest account and the last month of the generated range
+    name = max(data['accounts'], key=lambda n: len(data['accounts'][n]))
+    last = dt.date(START_DATE.year + size['years'], 1, 1) - dt.timedelta(days=1)
+    year_month = last.strftime('%Y%m')
+    results = {
+        'transactions': sum(len(txns) for txns in data['accounts'].values()),
+        'from_dict': _time(lambda _: Ledger.from_dict(data), repeat=repeat),
+        'to_dict': _time(lambda _: ledger.to_dict(), repeat=repeat),
+    }
+
+    def _add_transactions(lg):
+        rnd = random.Random(seed)
+        names = list(data['accounts'])
+        for i in range(ADD_TRANSACTIONS):
+            date = last + dt.timedelta(days=1 + i % 28)
+            lg.add_transaction(date.strftime(TXN_DATE_FORMAT), rnd.choice(names), 'D', 10.0)
+
+    results['add_transaction'] = _time(
+        _add_transactions, setup=lambda: Ledger.from_dict(data), repeat=repeat
+    ) / ADD_TRANSACTIONS
+    results['statement_cold'] = _time(
+        lambda lg: lg.statement(name, year_month), setup=lambda: Ledger.from_dict(data), repeat=repeat
+    )
+    ledger.statement(name, year_month)
+    results['statement_warm'] = _time(lambda _: ledger.statement(name, year_month), repeat=repeat)
+    acc = ledger.accounts[name]
+    results['compute_interest_for_month'] = _time(
+        lambda _: ledger._compute_interest_for_month(acc, last.year, last.month), repeat=repeat
+    )
+    # queued saves of the live ledger land in the real files before they are swapped out
+    state.flush()
+    with tempfile.TemporaryDirectory() as tmp:
+        pinned = {
+            'STATE_FILE': Path(tmp) / 'state.json',
+            'JOURNAL_FILE': Path(tmp) / 'state.journal',
+            'HISTORY_FILE': Path(tmp) / 'state.history',
+            'MODE': 'snapshot',
+            'BACKEND': 'json',
+            'SAVE_POLICY': 'immediate',
+        }
+        saved = {name: getattr(state, name) for name in pinned}
+        try:
+            for name, value in pinned.items():
+                setattr(state, name, value)
+            results['state_save'] = _time(lambda _: state.save(ledger), repeat=repeat)
+            results['state_load'] = _time(lambda _: state.load(), repeat=repeat)
+        finally:
+            for name, value in saved.items():
+                setattr(state, name, value)
+    return results
+
+
+def run(sizes, seed: int = SEED, repeat: int = REPEAT) -> dict:
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeat': repeat,
+            'sizes': {name: SIZES[name] for name in sizes},
+        },
+        'results': {name: run_size(SIZES[name], seed=seed, repeat=repeat) for name in sizes},
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """benchmarks slower than baseline by more than tolerance, as (size, name, ratio)"""
+    regressions = []
+    for size, results in report['results'].items():
+        for name, seconds in results.items():
+            base = baseline.get('results', {}).get(size, {}).get(name)
+            if name == 'transactions' or not base:
+                continue
+            ratio = seconds / base
+            if ratio > 1 + tolerance:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+# entry point ----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ledger benchmarks')
+    parser.add_argument('--sizes', default='small,medium', help=f"comma separated from {', '.join(SIZES)}")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown ratio over baseline')
+    args = parser.parse_args(argv)
+    report = run(args.sizes.split(','), seed=args.seed, repeat=args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    if args.baseline:
+        regressions = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for size, name, ratio in regressions:
+            print(f'REGRESSION {size} {name}: {ratio:.2f}x baseline', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 """Unit tests"""
 # dependencies ---------------------------------------------------------------------------------------
+import asyncio
+import datetime as dt
+import io
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from bank import drive, state
+from pathlib import Path
+import benchmarks
+from unittest import mock
+from bank import drive, server, state, stats, storage, ui
+from bank import ledger as ledger_module
+from bank.ledger import ColumnarAccount, Ledger, parse_date
 
 
 # unit tests ---------------------------------------------------------------------------------------
 class BankTests(unittest.TestCase):
     def setUp(self):
         # ensure fresh state
-        if state.STATE_FILE.exists():
-            state.STATE_FILE.unlink()
+        state.MODE = 'snapshot'
+        state.BACKEND = 'json'
+        for path in (state.STATE_FILE, state.JOURNAL_FILE, state.SQLITE_FILE, state.BINARY_FILE, state.ARCHIVE_FILE,
+                     state.HISTORY_FILE):
+            if path.exists():
+                path.unlink()
+        shutil.rmtree(state.SHARD_DIR, ignore_errors=True)
         drive.state_refresh()
 
     def test_01_deposit_and_withdraw(self):
@@ -81,6 +101,845 @@ class BankTests(unittest.TestCase):
         resp = drive.statement('AC007', '242007')
         self.assertEqual(-1, resp['success'])
 
+    def test_11_backdated_transactions_indexed_balance(self):
+        drive.transaction_add('20230610', 'AC008', 'D', 100)
+        drive.transaction_add('20230605', 'AC008', 'D', 30)
+        drive.transaction_add('20230610', 'AC008', 'W', 20)
+        r = drive.transaction_add('20230605', 'AC008', 'W', 25)
+        self.assertEqual('20230605-02', r['txn_id'])
+        acc = drive.ledger.accounts['AC008']
+        self.assertEqual(['20230605-01', '20230605-02', '20230610-01', '20230610-02'],
+                         [t.txn_id for t in acc.transactions])
+        self.assertAlmostEqual(5.0, acc.balance_before(dt.date(2023, 6, 10)))
+        self.assertAlmostEqual(85.0, acc.balance_through(dt.date(2023, 6, 10)))
+        resp = drive.transaction_add('20230605', 'AC008', 'W', 10)
+        self.assertEqual(-1, resp['success'])
+
+    def test_12_close_month_all_accounts(self):
+        drive.transaction_add('20230601', 'AC003', 'D', 50)
+        drive.transaction_add('20230715', 'AC009', 'D', 80)
+        drive.transaction_add('20230901', 'AC010', 'D', 80)
+        drive.rule_add('20230101', 'R1', 2.0)
+        resp = drive.close_month('202307')
+        self.assertEqual(1, resp['success'])
+        self.assertEqual(2, resp['accounts'])
+        self.assertEqual(2, resp['posted'])
+        self.assertEqual([], drive.ledger.accounts['AC010'].transactions_in_month(2023, 7))
+        stmt = drive.statement('AC003', '202307')
+        self.assertIn('| 20230731 |             | I    |    0.09 |    50.17 |', stmt['statement'])
+
+    def test_13_interest_rate_timeline_segments(self):
+        drive.transaction_add('20230505', 'AC001', 'D', 100)
+        drive.transaction_add('20230601', 'AC001', 'D', 150)
+        drive.transaction_add('20230626', 'AC001', 'W', 20)
+        drive.transaction_add('20230626', 'AC001', 'W', 100)
+        drive.rule_add('20230101', 'RULE01', 1.95)
+        drive.rule_add('20230520', 'RULE02', 1.90)
+        drive.rule_add('20230615', 'RULE03', 2.50)
+        drive.rule_add('20230615', 'RULE03', 2.20)
+        ledger = drive.ledger
+        self.assertEqual(0.0, ledger._rate_for_date(dt.date(2022, 12, 31)))
+        self.assertEqual(1.90, ledger._rate_for_date(dt.date(2023, 6, 14)))
+        self.assertEqual(2.20, ledger._rate_for_date(dt.date(2023, 6, 15)))
+        interest = ledger._compute_interest_for_month(ledger.accounts['AC001'], 2023, 6)
+        self.assertAlmostEqual(0.39, interest, places=2)
+
+    def test_14_journal_replay_and_compaction(self):
+        state.MODE = 'journal'
+        drive.transaction_add('20230601', 'AC011', 'D', 100)
+        drive.transaction_add('20230602', 'AC011', 'W', 30)
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.statement('AC011', '202306')
+        self.assertEqual(4, len(state.JOURNAL_FILE.read_text().splitlines()))
+        before = drive.ledger.to_dict()
+        drive.state_refresh()
+        self.assertFalse(state.JOURNAL_FILE.exists())
+        state.COMPACT_EVERY, compact_every = 2, state.COMPACT_EVERY
+        try:
+            drive.transaction_add('20230603', 'AC011', 'D', 5)
+            drive.transaction_add('20230604', 'AC011', 'D', 5)
+            self.assertFalse(state.JOURNAL_FILE.exists())
+            drive.transaction_add('20230605', 'AC011', 'D', 5)
+        finally:
+            state.COMPACT_EVERY = compact_every
+        ledger = state.load()
+        self.assertEqual(before['rules'], ledger.to_dict()['rules'])
+        self.assertEqual(drive.ledger.to_dict(), ledger.to_dict())
+        self.assertEqual(['20230605-01'], [t.txn_id for t in ledger.accounts['AC011'].transactions_on(dt.date(2023, 6, 5))])
+        # a server batch is appended with one write and one fsync per file
+        batch = [
+            {'op': 'T', 'date': f'2023060{day}', 'account': 'AC011', 'type': 'D', 'amount': 1.0}
+            for day in (6, 7, 8)
+        ]
+        for record in batch:
+            drive.ledger.add_transaction(record['date'], 'AC011', 'D', 1)
+        lines = len(state.JOURNAL_FILE.read_text().splitlines())
+        state.FSYNC = True
+        try:
+            with mock.patch('bank.state.os.fsync') as fsync:
+                server.LedgerServer(drive.ledger)._persist(batch)
+        finally:
+            state.FSYNC = False
+        # the journal and the history, once each
+        self.assertEqual(2, fsync.call_count)
+        self.assertEqual(lines + 3, len(state.JOURNAL_FILE.read_text().splitlines()))
+        self.assertEqual(drive.ledger.to_dict(), state.load().to_dict())
+
+    def test_15_sqlite_backend_lazy_accounts(self):
+        state.BACKEND = 'sqlite'
+        drive.state_refresh()
+        drive.transaction_add('20230601', 'AC012', 'D', 100)
+        drive.transaction_add('20230601', 'AC013', 'D', 40)
+        drive.rule_add('20230101', 'R1', 2.0)
+        stmt = drive.statement('AC012', '202306')
+        drive.state_refresh()
+        self.assertEqual({}, drive.ledger.accounts.loaded)
+        self.assertIn('AC013', drive.ledger.accounts)
+        self.assertEqual(stmt, drive.statement('AC012', '202306'))
+        self.assertEqual(['AC012'], list(drive.ledger.accounts.loaded))
+        self.assertEqual(1, drive.transaction_add('20230603', 'AC013', 'W', 40)['success'])
+        self.assertEqual(-1, drive.transaction_add('20230603', 'AC013', 'W', 1)['success'])
+        # account names come from the accounts table, not a scan of the transactions
+        store = state.store()
+        self.assertEqual([('AC012',), ('AC013',)], store.conn.execute('SELECT name FROM accounts ORDER BY name').fetchall())
+        with store.conn:
+            store.conn.execute('DROP TABLE accounts')
+        # an older database without the table is backfilled once
+        older = storage.SqliteStore(state.SQLITE_FILE)
+        self.assertEqual({'AC012', 'AC013'}, older.names())
+        older.close()
+        store.close()
+        state.BACKEND = 'json'
+
+    def test_16_transactions_import_batch(self):
+        rows = [
+            ['20230605', 'AC014', 'W', '30'],
+            ['20230601', 'AC014', 'D', '100'],
+            ['20230601', 'AC015', 'D', '10'],
+            ['20230601', 'AC014', 'D', '5'],
+            ['20230602', 'AC015', 'W', '20'],
+            ['20230602', 'AC015', 'X'],
+        ]
+        with mock.patch.object(state, 'save') as save:
+            resp = drive.transactions_import(rows, batch_size=4)
+        self.assertEqual(2, save.call_count)
+        self.assertEqual(1, resp['success'])
+        self.assertEqual(4, resp['imported'])
+        self.assertEqual([5, 6], [e['row'] for e in resp['errors']])
+        self.assertEqual(-1, resp['errors'][0]['success'])
+        self.assertEqual(['20230601-01', '20230601-02', '20230605-01'],
+                         [t.txn_id for t in drive.ledger.accounts['AC014'].transactions])
+        self.assertAlmostEqual(75.0, drive.ledger.accounts['AC014'].balance_through(dt.date(2023, 6, 30)))
+
+    def test_17_cli_import_stdin(self):
+        output = []
+        feed = io.StringIO('date,account,type,amount\n20230601,AC016,D,100\n\n20230602,AC016,W,40\n')
+        with mock.patch('sys.stdin', feed):
+            code = ui.BatchApp(output_fn=output.append).import_transactions('-')
+        self.assertEqual(0, code)
+        self.assertEqual(['Imported 2 transactions with 0 errors'], output)
+        self.assertIn('AC016', state.load().accounts)
+
+    def test_18_sharded_backend_writes_dirty_shards(self):
+        state.BACKEND = 'shards'
+        drive.state_refresh()
+        drive.transaction_add('20230601', 'AC017', 'D', 100)
+        drive.transaction_add('20230601', 'AC/018', 'D', 40)
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.state_refresh()
+        self.assertEqual({}, drive.ledger.accounts.loaded)
+        shard = state.SHARD_DIR / 'accounts' / 'AC%2F018.json'
+        mtime = shard.stat().st_mtime_ns
+        drive.transaction_add('20230602', 'AC017', 'W', 10)
+        self.assertEqual(['AC017'], list(drive.ledger.accounts.loaded))
+        self.assertEqual(mtime, shard.stat().st_mtime_ns)
+        ledger = state.load()
+        self.assertEqual(2, len(ledger.accounts['AC017'].transactions))
+        self.assertEqual(1, len(ledger.accounts['AC/018'].transactions))
+        self.assertEqual(2.0, ledger.rules[0].rate)
+        state.BACKEND = 'json'
+
+    def test_19_backdated_changes_reaccrue_interest(self):
+        drive.transaction_add('20230601', 'AC003', 'D', 50)
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.statement('AC003', '202308')
+        acc = drive.ledger.accounts['AC003']
+        # backdated deposit restates June onwards on the next statement
+        drive.transaction_add('20230615', 'AC003', 'D', 50)
+        drive.state_refresh()
+        self.assertEqual({'AC003': '20230615'}, drive.ledger.to_dict()['dirty_from'])
+        stmt = drive.statement('AC003', '202306')
+        self.assertIn('| 20230630 |             | I    |    0.13 |   100.13 |', stmt['statement'])
+        acc = drive.ledger.accounts['AC003']
+        self.assertEqual([], acc.transactions_on(dt.date(2023, 7, 31)))
+        # a past rule change restates every posted month from its date
+        drive.statement('AC003', '202308')
+        drive.rule_add('20230801', 'R2', 4.0)
+        stmt = drive.statement('AC003', '202308')
+        self.assertIn('| 20230831 |             | I    |    0.34 |   100.64 |', stmt['statement'])
+        self.assertEqual(1, len(acc.transactions_on(dt.date(2023, 7, 31))))
+        self.assertNotIn('dirty_from', drive.ledger.to_dict())
+
+    def test_20_parallel_statements_for_month(self):
+        drive.rule_add('20230101', 'R1', 2.0)
+        for i in range(6):
+            drive.transaction_add('20230601', f'AC1{i:02d}', 'D', 50 + i)
+        drive.statement('AC100', '202306')
+        drive.transaction_add('20230615', 'AC100', 'D', 50)
+        expected = state.load()
+        serial = {name: expected.statement(name, '202307') for name in expected.accounts}
+        with tempfile.TemporaryDirectory() as out_dir:
+            resp = drive.statements_for_month('202307', workers=2, out_dir=out_dir)
+            self.assertEqual(1, resp['success'])
+            self.assertEqual(serial, resp['statements'])
+            self.assertEqual(serial['AC103']['statement'] + '\n', (Path(out_dir) / 'AC103_202307.txt').read_text())
+        self.assertEqual(expected.to_dict(), drive.ledger.to_dict())
+        self.assertEqual(expected.to_dict(), state.load().to_dict())
+
+    def test_21_columnar_account_matches_objects(self):
+        rows = [
+            ['20230505', 'AC001', 'D', '100'],
+            ['20230601', 'AC001', 'D', '150'],
+            ['20230626', 'AC001', 'W', '20'],
+            ['20230626', 'AC001', 'W', '100'],
+            ['20230710', 'AC001', 'W', '30.55'],
+        ]
+        ledgers = [Ledger(), Ledger(account_cls=ColumnarAccount)]
+        for ledger in ledgers:
+            ledger.import_transactions(enumerate(rows, 1))
+            ledger.add_rule('20230101', 'RULE01', 1.95)
+            ledger.add_rule('20230520', 'RULE02', 1.90)
+            ledger.add_rule('20230615', 'RULE03', 2.20)
+            ledger.statement('AC001', '202306')
+            ledger.add_transaction('20230603', 'AC001', 'D', 10)
+        objects, columnar = ledgers
+        acc = columnar.accounts['AC001']
+        self.assertIsInstance(acc, ColumnarAccount)
+        self.assertEqual(objects.statement('AC001', '202307'), columnar.statement('AC001', '202307'))
+        self.assertEqual(objects.to_dict(), columnar.to_dict())
+        self.assertEqual(14014, acc.balance_cents_before(dt.date(2023, 6, 27)))
+        self.assertEqual('20230603-01', acc.transactions_on(dt.date(2023, 6, 3))[0].txn_id)
+        restored = Ledger.from_dict(columnar.to_dict(), account_cls=ColumnarAccount)
+        self.assertEqual(columnar.to_dict(), restored.to_dict())
+
+    def test_22_benchmark_generator_seeded(self):
+        size = {'accounts': 3, 'years': 1, 'txns_per_day': 0.3, 'rule_changes': 2}
+        data = benchmarks.generate_ledger(seed=7, **size)
+        self.assertEqual(data, benchmarks.generate_ledger(seed=7, **size))
+        self.assertNotEqual(data, benchmarks.generate_ledger(seed=8, **size))
+        self.assertEqual(3, len(data['rules']))
+        ledger = Ledger.from_dict(data)
+        for acc in ledger.accounts.values():
+            self.assertGreaterEqual(acc.balance_through(dt.date(2021, 12, 31)), 0)
+        report = {'results': {'small': {'to_dict': 2.0, 'from_dict': 1.0}}}
+        baseline = {'results': {'small': {'to_dict': 1.0, 'from_dict': 1.0}}}
+        self.assertEqual([('small', 'to_dict', 2.0)], benchmarks.compare(report, baseline, 0.25))
+        # a run leaves the real state and its uncompacted journal alone
+        state.MODE = 'journal'
+        drive.transaction_add('20230601', 'AC001', 'D', 10)
+        journal = state.JOURNAL_FILE.read_text()
+        results = benchmarks.run_size(size, seed=7, repeat=1)
+        self.assertIn('state_load', results)
+        self.assertEqual(journal, state.JOURNAL_FILE.read_text())
+        self.assertEqual(('journal', 'json'), (state.MODE, state.BACKEND))
+        self.assertEqual(10.0, state.load().accounts['AC001'].transactions[0].amount)
+
+    def test_23_stats_counters_and_cli_view(self):
+        stats.reset()
+        drive.transaction_add('20230601', 'AC003', 'D', 50)
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.statement('AC003', '202307')
+        snapshot = stats.snapshot()
+        self.assertEqual(2, snapshot['counters']['ledger.accrual_months'])
+        self.assertEqual(61, snapshot['counters']['ledger.accrual_days'])
+        self.assertGreater(snapshot['counters']['state.bytes_written'], 0)
+        self.assertEqual(1, snapshot['latency']['drive.statement']['count'])
+        self.assertEqual(1, snapshot['latency']['ledger.render']['count'])
+        output = []
+        inputs = iter(['s', 'q'])
+        ui.BankApp(input_fn=lambda _: next(inputs), output_fn=output.append).run()
+        self.assertIn('[S] Stats', output[1])
+        self.assertIn('drive.statement', output[2])
+        # each decorated call times itself while another call overlaps it
+        started, done = threading.Event(), threading.Event()
+
+        @stats.timed('test.overlap')
+        def call(slow):
+            if slow:
+                started.set()
+                done.wait()
+
+        slow = threading.Thread(target=call, args=(True,))
+        slow.start()
+        started.wait()
+        time.sleep(0.05)
+        call(False)
+        done.set()
+        slow.join()
+        self.assertGreaterEqual(stats.histograms['test.overlap'].max, 50)
+
+    def test_24_async_server_serializes_writes(self):
+        async def _request(port, requests):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for i, (action, args) in enumerate(requests):
+                writer.write((json.dumps({'id': i, 'action': action, 'args': args}) + '\n').encode())
+            await writer.drain()
+            responses = [json.loads(await reader.readline()) for _ in requests]
+            writer.close()
+            await writer.wait_closed()
+            return sorted(responses, key=lambda r: r['id'])
+
+        async def _run():
+            app = server.LedgerServer(drive.ledger)
+            srv = await app.start(port=0)
+            port = srv.sockets[0].getsockname()[1]
+            deposits = [
+                ('transaction_add', {'date': '20230601', 'account': f'AC2{c}', 't_type': 'D', 'amount': 10})
+                for c in range(5)
+            ]
+            clients = [_request(port, deposits) for _ in range(4)]
+            results = await asyncio.gather(*clients)
+            stmt = await _request(port, [
+                ('statement', {'account': 'AC20', 'year_month': '202306'}),
+                ('frobnicate', {}),
+            ])
+            await app.stop()
+            return results, stmt
+
+        results, stmt = asyncio.run(_run())
+        txn_ids = sorted(r['txn_id'] for client in results for r in client)
+        self.assertEqual(sorted(f'20230601-{n:02d}' for n in range(1, 5) for _ in range(5)), txn_ids)
+        self.assertEqual(1, stmt[0]['success'])
+        self.assertIn('20230601-04', stmt[0]['statement'])
+        self.assertEqual(-1, stmt[1]['success'])
+        # the snapshot read does not post interest into the live ledger
+        self.assertEqual(4, len(drive.ledger.accounts['AC20'].transactions))
+        self.assertEqual(4, len(state.load().accounts['AC24'].transactions))
+
+    def test_25_threaded_ledger_no_lost_updates(self):
+        ledger = Ledger()
+        ledger.add_rule('20230101', 'R1', 2.0)
+        accounts = ['AC301', 'AC302', 'AC303']
+        successes = []
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def _worker(seed):
+            rnd = random.Random(seed)
+            for _ in range(30):
+                name = rnd.choice(accounts)
+                t_type = rnd.choice('DWW')
+                amount = rnd.randint(1, 20)
+                try:
+                    # one date, so id order is commit order and the check covers the whole balance
+                    txn = ledger.add_transaction('20230601', name, t_type, amount)
+                except ValueError:
+                    continue
+                successes.append((name, txn.txn_id, t_type, amount))
+                if rnd.random() < 0.05:
+                    ledger.statement(name, '202305')
+                    ledger.add_rule('20230101', 'R1', rnd.choice([1.0, 2.0]))
+
+        threads = [threading.Thread(target=_worker, args=(seed,)) for seed in range(8)]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        for name in accounts:
+            acc = ledger.accounts[name]
+            txns = [t for t in acc.transactions if t.type != 'I']
+            mine = [s for s in successes if s[0] == name]
+            self.assertEqual(len(mine), len(txns))
+            self.assertEqual(len(txns), len({t.txn_id for t in txns}))
+            self.assertEqual(sorted(s[1] for s in mine), sorted(t.txn_id for t in txns))
+            expected = sum(a if t == 'D' else -a for _, _, t, a in mine)
+            self.assertAlmostEqual(expected, acc.balance_through(dt.date(2023, 6, 30)))
+            self.assertGreaterEqual(min(acc._balances), 0)
+
+    def test_26_binary_snapshot_roundtrip_and_lazy_load(self):
+        drive.transaction_add('20230601', 'AC003', 'D', 50)
+        drive.transaction_add('20230601', 'AC401', 'D', 75.25)
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.statement('AC003', '202307')
+        drive.transaction_add('20230615', 'AC003', 'D', 50)
+        data = drive.ledger.to_dict()
+        self.assertIn('dirty_from', data)
+        with tempfile.TemporaryDirectory() as tmp:
+            storage.json_to_binary(state.STATE_FILE, Path(tmp) / 'state.bin')
+            storage.binary_to_json(Path(tmp) / 'state.bin', Path(tmp) / 'state.json')
+            self.assertEqual(data, json.loads((Path(tmp) / 'state.json').read_text()))
+        state.BACKEND = 'binary'
+        drive.state_refresh(state_override=data)
+        drive.state_refresh()
+        self.assertEqual({}, drive.ledger.accounts.loaded)
+        drive.transaction_add('20230602', 'AC401', 'W', 5)
+        self.assertEqual(['AC401'], list(drive.ledger.accounts.loaded))
+        stmt = drive.statement('AC003', '202306')
+        self.assertIn('| 20230630 |             | I    |    0.13 |   100.13 |', stmt['statement'])
+        ledger = state.load()
+        self.assertEqual(drive.ledger.to_dict(), ledger.to_dict())
+        state.store().close()
+        state.BACKEND = 'json'
+
+    def test_27_statement_range_streams_months(self):
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.transaction_add('20230305', 'AC001', 'D', 100)
+        drive.transaction_add('20230520', 'AC001', 'W', 20)
+        monthly = state.load()
+        expected = '\n\n'.join(monthly.statement('AC001', ym)['statement'] for ym in ('202303', '202304', '202305'))
+        resp = drive.statement_range('AC001', '202303', '202305')
+        self.assertEqual(1, resp['success'])
+        self.assertEqual(expected, resp['statement'])
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp) / 'range.txt'
+            resp = drive.statement_range('AC001', '202303', '202305', out_path=str(out))
+            self.assertEqual(expected + '\n', out.read_text())
+            self.assertEqual(len(expected.split('\n')), resp['lines'])
+        self.assertEqual(-1, drive.statement_range('AC001', '202305', '202303')['success'])
+
+    def test_28_from_dict_bulk_load(self):
+        drive.rule_add('20230101', 'R1', 2.0)
+        for day in (5, 1, 20, 1):
+            drive.transaction_add(f'202306{day:02d}', 'AC001', 'D', 10 + day)
+        drive.statement('AC001', '202306')
+        data = drive.ledger.to_dict()
+        ledger = Ledger.from_dict(data)
+        self.assertEqual(data, ledger.to_dict())
+        self.assertEqual(data, Ledger.from_dict(data, account_cls=ColumnarAccount).to_dict())
+        # rows out of persisted order are still sorted and indexed
+        data['accounts']['AC001'].reverse()
+        ledger = Ledger.from_dict(data)
+        self.assertEqual(Ledger.from_dict(drive.ledger.to_dict()).to_dict(), ledger.to_dict())
+        self.assertEqual(37.0, ledger.accounts['AC001'].balance_through(dt.date(2023, 6, 5)))
+        self.assertIs(parse_date('20230601'), parse_date('20230601'))
+        stats.reset()
+        inputs = iter(['q'])
+        ui.BankApp(input_fn=lambda _: next(inputs), output_fn=lambda _: None).run()
+        self.assertEqual(1, stats.snapshot()['latency']['drive.state_refresh']['count'])
+
+    def test_29_book_totals_incremental(self):
+        ledger = Ledger.from_dict(benchmarks.generate_ledger(accounts=5, years=1, txns_per_day=0.5, rule_changes=4))
+        ledger.close_month('202103')
+
+        def check():
+            for date_str in ('20210101', '20210331', '20210415', '20211231'):
+                date = dt.datetime.strptime(date_str, '%Y%m%d').date()
+                expected = sum(acc.balance_through(date) for acc in ledger.accounts.values())
+                self.assertAlmostEqual(expected, ledger.book_balance(date_str), places=6)
+            flows = ledger.flows('20210301', '20210331')
+            rows = [t for acc in ledger.accounts.values() for t in acc.transactions_in_month(2021, 3)]
+            self.assertAlmostEqual(sum(t.amount for t in rows if t.type == 'I'), flows['interest'], places=6)
+            self.assertAlmostEqual(
+                ledger.book_balance('20210331') - ledger.book_balance('20210228'), flows['net'], places=6
+            )
+            balances = {name: acc.balance_through(dt.date(2099, 12, 31)) for name, acc in ledger.accounts.items()}
+            top = sorted(balances.items(), key=lambda item: -item[1])[:2]
+            self.assertEqual([name for name, _ in top], [name for name, _ in ledger.top_balances(2)])
+
+        check()
+        # chronological and backdated postings, re-accrual and a new account
+        ledger.add_transaction('20220105', 'AC000000', 'D', 1000)
+        ledger.add_transaction('20210210', 'AC000001', 'D', 5000)
+        ledger.add_transaction('20210320', 'NEW', 'D', 250.5)
+        ledger.add_rule('20210301', 'R9', 3.5)
+        ledger.close_month('202104')
+        check()
+        self.assertEqual(0.0, ledger.flows('20200101', '20201231')['net'])
+        with self.assertRaises(ValueError):
+            ledger.flows('20210201', '20210101')
+
+    def test_30_statement_cache_versioned_lru(self):
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.transaction_add('20230601', 'AC001', 'D', 100)
+        stats.reset()
+        first = drive.statement('AC001', '202306')
+        written = stats.counters['state.bytes_written']
+        self.assertEqual(first, drive.statement('AC001', '202306'))
+        self.assertEqual(written, stats.counters['state.bytes_written'])
+        self.assertEqual(1, stats.counters['ledger.statement_cache_hits'])
+        self.assertEqual(1, stats.counters['ledger.statement_cache_misses'])
+        # a new transaction or rule invalidates the rendered statement
+        drive.transaction_add('20230610', 'AC001', 'D', 50)
+        self.assertIn('150.', drive.statement('AC001', '202306')['statement'])
+        drive.rule_add('20230601', 'R2', 4.0)
+        self.assertNotEqual(first['interest'], drive.statement('AC001', '202306')['interest'])
+        self.assertEqual(1, stats.counters['ledger.statement_cache_hits'])
+        self.assertEqual(drive.ledger.to_dict(), state.load().to_dict())
+        with mock.patch('bank.ledger.STATEMENT_CACHE_SIZE', 2):
+            for year_month in ('202307', '202308', '202309'):
+                drive.statement('AC001', year_month)
+        self.assertEqual(2, stats.counters['ledger.statement_cache_evictions'])
+        self.assertEqual(
+            [('AC001', '202308'), ('AC001', '202309')], list(drive.ledger._statement_cache)
+        )
+
+    def test_31_archive_months_into_checkpoint(self):
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.transaction_add('20230105', 'AC001', 'D', 100)
+        drive.transaction_add('20230310', 'AC001', 'W', 30)
+        drive.transaction_add('20230520', 'AC001', 'D', 40)
+        drive.transaction_add('20230201', 'AC002', 'D', 70)
+        months = ('202301', '202302', '202303', '202304', '202305', '202306')
+        drive.close_month('202306')
+        before = {ym: drive.statement('AC001', ym) for ym in months}
+        book = drive.ledger.book_balance('20230630')
+        carried = round(drive.ledger.accounts['AC001'].balance_through(dt.date(2023, 3, 31)), 2)
+        columnar = Ledger.from_dict(drive.ledger.to_dict(), account_cls=ColumnarAccount)
+        # only months before the current one can be folded
+        current = dt.date.today().strftime('%Y%m')
+        for year_month in (current, '209912'):
+            resp = drive.archive(year_month)
+            self.assertEqual((-1, 'Only months before the current month can be archived'), (resp['success'], resp['error']))
+        self.assertEqual('20230105-01', drive.ledger.accounts['AC001'].transactions[0].txn_id)
+        resp = drive.archive('202303')
+        self.assertEqual(1, resp['success'])
+        self.assertEqual({'accounts': 2, 'archived': 8}, {k: resp[k] for k in ('accounts', 'archived')})
+        acc = drive.ledger.accounts['AC001']
+        self.assertEqual(('B', carried), (acc.transactions[0].type, acc.transactions[0].amount))
+        self.assertEqual(['20230331-B', '20230430-I'], [t.txn_id for t in acc.transactions[:2]])
+        # retained months from the checkpoint, archived months from the cold archive
+        for ym in months:
+            self.assertEqual(before[ym], drive.statement('AC001', ym))
+        self.assertEqual(book, drive.ledger.book_balance('20230630'))
+        self.assertEqual('Date falls in an archived month', drive.transaction_add('20230215', 'AC001', 'D', 5)['error'])
+        with self.assertRaises(ValueError):
+            drive.ledger.statement('AC001', '202302')
+        data = drive.ledger.to_dict()
+        self.assertEqual(data, state.load().to_dict())
+        self.assertEqual(data, Ledger.from_dict(data, account_cls=ColumnarAccount).to_dict())
+        columnar.archive('202303')
+        self.assertEqual(data, columnar.to_dict())
+        state.BACKEND = 'binary'
+        drive.state_refresh(state_override=data)
+        self.assertEqual(data, state.load().to_dict())
+        state.store().close()
+        state.BACKEND = 'json'
+        # archiving again only moves the newly closed months
+        drive.state_refresh(state_override=data)
+        self.assertEqual(1, drive.archive('202304')['success'])
+        self.assertEqual(before['202304'], drive.statement('AC001', '202304'))
+        self.assertEqual(before['202302'], drive.statement('AC001', '202302'))
+
+    def test_32_deferred_save_policies(self):
+        def stored():
+            return json.loads(state.STATE_FILE.read_text())['accounts']
+
+        def wait_for(predicate):
+            deadline = time.monotonic() + 5
+            while not predicate() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return predicate()
+
+        try:
+            state.SAVE_POLICY, state.SAVE_EVERY = 'every', 3
+            drive.transaction_add('20230601', 'AC001', 'D', 10)
+            drive.transaction_add('20230602', 'AC001', 'D', 10)
+            self.assertNotIn('AC001', stored())
+            drive.transaction_add('20230603', 'AC001', 'D', 10)
+            self.assertTrue(wait_for(lambda: len(stored().get('AC001', [])) == 3))
+            state.SAVE_POLICY, state.SAVE_INTERVAL_MS = 'interval', 50
+            drive.transaction_add('20230604', 'AC002', 'D', 10)
+            drive.transaction_add('20230605', 'AC002', 'D', 10)
+            self.assertTrue(wait_for(lambda: len(stored().get('AC002', [])) == 2))
+            # explicit flush on quit, the snapshot is replaced atomically
+            state.SAVE_POLICY, state.SAVE_INTERVAL_MS = 'interval', 60000
+            time.sleep(0.1)
+            drive.transaction_add('20230606', 'AC003', 'D', 10)
+            self.assertNotIn('AC003', stored())
+            inputs = iter(['q'])
+            ui.BankApp(input_fn=lambda _: next(inputs), output_fn=lambda _: None).run()
+            # the refresh flushed AC003 before loading, quit flushed the refreshed state
+            self.assertEqual(drive.ledger.to_dict()['accounts'], stored())
+            drive.transaction_add('20230607', 'AC003', 'D', 10)
+            state.MODE = 'journal'
+            drive.transaction_add('20230608', 'AC003', 'D', 10)
+            state.flush()
+            self.assertEqual(drive.ledger.to_dict(), state.load().to_dict())
+            self.assertFalse(state.STATE_FILE.with_name(state.STATE_FILE.name + '.tmp').exists())
+            # the sqlite connection is written from the autosave thread
+            state.BACKEND, state.SAVE_POLICY, state.SAVE_EVERY = 'sqlite', 'every', 1
+            drive.state_refresh()
+            drive.transaction_add('20230601', 'AC004', 'D', 10)
+            drive.transaction_add('20230602', 'AC004', 'D', 10)
+            self.assertTrue(wait_for(lambda: state._pending is None))
+            drive.state_refresh()
+            self.assertEqual(2, len(drive.ledger.accounts['AC004'].transactions))
+            self.assertNotIn('state.flush_failed', stats.counters)
+            # a failed write stays queued for the next flush
+            state.SAVE_POLICY, state.SAVE_INTERVAL_MS = 'interval', 60000
+            drive.transaction_add('20230603', 'AC004', 'D', 10)
+            with mock.patch('bank.state._write', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    state.flush()
+            self.assertIsNotNone(state._pending)
+            drive.state_refresh()
+            self.assertEqual(3, len(drive.ledger.accounts['AC004'].transactions))
+        finally:
+            state.flush()
+            state.SAVE_POLICY = 'immediate'
+            if state.BACKEND != 'json':
+                state.store().close()
+                state.BACKEND = 'json'
+
+    def test_33_simulate_rules_side_effect_free(self):
+        ledger = Ledger.from_dict(benchmarks.generate_ledger(accounts=8, years=1, txns_per_day=0.5, rule_changes=4))
+        ledger.close_month('202103')
+        before = ledger.to_dict()
+        schedules = {
+            'current': ledger._rules_data(),
+            'flat': [{'date': '20200101', 'rule_id': 'F', 'rate': 3.0}],
+            'none': [],
+        }
+        result = ledger.simulate_rules(schedules, '202104', '202109')
+        self.assertEqual(before, ledger.to_dict())
+        self.assertEqual(0.0, result['none']['total'])
+        # the current schedule reproduces what accrual actually posts
+        ledger.close_month('202109')
+        for name, acc in ledger.accounts.items():
+            posted = [t.amount for t in acc.transactions_between(dt.date(2021, 4, 1), dt.date(2021, 9, 30)) if t.type == 'I']
+            self.assertAlmostEqual(sum(posted), result['current']['accounts'][name], places=2)
+        self.assertAlmostEqual(sum(result['flat']['accounts'].values()), result['flat']['total'], places=2)
+        with self.assertRaises(ValueError):
+            ledger.simulate_rules({'bad': [{'date': '20210101', 'rule_id': 'B', 'rate': 150}]}, '202101', '202102')
+        drive.transaction_add('20230601', 'AC001', 'D', 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'schedules.json'
+            path.write_text(json.dumps({'flat': [{'date': '20230101', 'rule_id': 'F', 'rate': 3.65}]}))
+            output = []
+            self.assertEqual(0, ui.BatchApp(output_fn=output.append).simulate(str(path), '202306', '202306', accounts=True))
+        self.assertEqual(['flat: 3.00', '  AC001: 3.00'], output)
+        self.assertEqual(['20230601-01'], [t.txn_id for t in drive.ledger.accounts['AC001'].transactions])
+
+    def test_34_as_of_statements_from_history(self):
+        drive.rule_add('20230101', 'R1', 2.0)
+        drive.transaction_add('20230601', 'AC001', 'D', 100)
+        seq = drive.ledger.seq
+        shown = drive.statement('AC001', '202306')
+        balance = drive.balance_as_of('AC001', '20230630')['balance']
+        moment = dt.datetime.now()
+        time.sleep(0.01)
+        # later backdated entry and rule change
+        drive.transaction_add('20230605', 'AC001', 'D', 50)
+        drive.rule_add('20230610', 'R2', 4.0)
+        self.assertNotEqual(shown, drive.statement('AC001', '202306'))
+        self.assertEqual(shown, drive.statement('AC001', '202306', as_of=seq))
+        self.assertEqual(shown, drive.statement('AC001', '202306', as_of=moment))
+        self.assertEqual(balance, drive.balance_as_of('AC001', '20230630', as_of=seq)['balance'])
+        self.assertEqual(100.0, drive.balance_as_of('AC001', '20230629', as_of=seq)['balance'])
+        self.assertEqual(-1, drive.statement('AC001', '202306', as_of=seq + 10)['success'])
+        self.assertEqual(-1, drive.statement('AC001', '202306', as_of=dt.datetime(2000, 1, 1))['success'])
+        self.assertEqual(-1, drive.statement('AC001', '202306', as_of=0)['success'])
+        # base rows plus the logged tail match a ledger rebuilt at each step
+        ledger = Ledger.from_dict(benchmarks.generate_ledger(accounts=2, years=1, txns_per_day=0.2, rule_changes=2))
+        expected = {0: ledger.statement('AC000001', '202112')}
+        for day in range(1, 11):
+            ledger.add_transaction(f'202106{day:02d}', 'AC000001', 'D', day)
+            if day == 5:
+                ledger.add_rule('20210301', 'R9', 4.5)
+            expected[ledger.seq] = Ledger.from_dict(ledger.to_dict()).statement('AC000001', '202112')
+        self.assertEqual(1, len(ledger._snapshots['AC000001']))
+        for at, statement in expected.items():
+            self.assertEqual(statement, ledger.statement('AC000001', '202112', as_of=at))
+        # live posted interest is reused before the first later change
+        ledger.statement('AC000001', '202112')
+        seq = ledger.seq
+        ledger.add_transaction('20211215', 'AC000001', 'D', 10)
+        stats.reset()
+        self.assertEqual(expected[seq], ledger.statement('AC000001', '202112', as_of=seq))
+        self.assertEqual(1, stats.counters['ledger.accrual_months'])
+        self.assertEqual(10, stats.counters['ledger.history_replayed'])
+
+    def test_35_archive_reloads_on_every_backend(self):
+        for backend in ('json', 'sqlite', 'shards', 'binary'):
+            with self.subTest(backend=backend):
+                self.setUp()
+                state.BACKEND = backend
+                drive.state_refresh()
+                drive.rule_add('20230101', 'R1', 2.0)
+                drive.transaction_add('20230105', 'AC001', 'D', 100)
+                drive.transaction_add('20230505', 'AC001', 'D', 100)
+                drive.close_month('202306')
+                drive.archive('202303')
+                balance = drive.ledger.accounts['AC001'].balance_through(dt.date(2023, 6, 30))
+                drive.state_refresh()
+                acc = drive.ledger.accounts['AC001']
+                self.assertAlmostEqual(balance, acc.balance_through(dt.date(2023, 6, 30)), places=6)
+                self.assertEqual('B', acc.transactions[0].type)
+                if backend != 'json':
+                    state.store().close()
+                state.BACKEND = 'json'
+
+    def test_36_backdated_before_first_accrued_month(self):
+        # changes dated before the month of the first posted interest
+        for change in ('txn', 'rule'):
+            with self.subTest(change=change):
+                ledger = Ledger()
+                ledger.add_rule('20230101', 'R1', 2.0)
+                ledger.add_transaction('20230601', 'AC001', 'D', 100)
+                ledger.statement('AC001', '202308')
+                if change == 'txn':
+                    ledger.add_transaction('20230515', 'AC001', 'D', 1000)
+                    expected = [0.93, 1.81, 1.87, 1.88]
+                else:
+                    ledger.add_rule('20230301', 'R9', 9.0)
+                    expected = [0.74, 0.77, 0.78]
+                reloaded = Ledger.from_dict(ledger.to_dict())
+                for each in (ledger, reloaded):
+                    each.statement('AC001', '202308')
+                    self.assertEqual(expected, [t.amount for t in each.accounts['AC001'].transactions if t.type == 'I'])
+
+    def test_37_reaccrual_survives_reload_on_every_backend(self):
+        for backend in ('json', 'sqlite', 'shards', 'binary'):
+            for change in ('txn', 'rule'):
+                with self.subTest(backend=backend, change=change):
+                    self.setUp()
+                    state.BACKEND = backend
+                    drive.state_refresh()
+                    drive.rule_add('20230101', 'R1', 2.0)
+                    drive.transaction_add('20230601', 'AC001', 'D', 100)
+                    drive.statement('AC001', '202308')
+                    if change == 'txn':
+                        drive.transaction_add('20230515', 'AC001', 'D', 1000)
+                        expected = '| 20230831 |             | I    |    1.88 |'
+                    else:
+                        drive.rule_add('20230301', 'R9', 9.0)
+                        expected = '| 20230831 |             | I    |    0.78 |'
+                    drive.state_refresh()
+                    self.assertIn(expected, drive.statement('AC001', '202308')['statement'])
+                    if backend != 'json':
+                        state.store().close()
+                    state.BACKEND = 'json'
+
+    def test_38_extra_load_keeps_unloaded_accounts(self):
+        for backend in ('sqlite', 'shards', 'binary'):
+            with self.subTest(backend=backend):
+                self.setUp()
+                state.BACKEND = backend
+                drive.state_refresh()
+                drive.transaction_add('20230601', 'AC001', 'D', 10)
+                drive.transaction_add('20230601', 'AC002', 'D', 20)
+                drive.state_refresh()
+                # a read-only load over the same store must not turn the next save into a replace
+                state.load()
+                drive.transaction_add('20230602', 'AC001', 'D', 10)
+                drive.state_refresh()
+                self.assertEqual(['AC001', 'AC002'], list(drive.ledger.accounts))
+                self.assertEqual(2, len(drive.ledger.accounts['AC001'].transactions))
+                # a ledger from elsewhere still replaces the stored book
+                state.save(Ledger.from_dict({'accounts': {'AC009': [
+                    {'date': '20230601', 'txn_id': '20230601-01', 'type': 'D', 'amount': 5.0},
+                ]}, 'rules': []}))
+                self.assertEqual(['AC009'], list(state.load().accounts))
+                state.store().close()
+                state.BACKEND = 'json'
+
+    def test_39_server_persist_failures_keep_live_mutations(self):
+        def add(app, day):
+            return app.handle('transaction_add', {'date': f'202306{day:02d}', 'account': 'AC001', 't_type': 'D', 'amount': 10})
+
+        async def _run():
+            app = server.LedgerServer(drive.ledger)
+            await app.start(port=0)
+            saved = await add(app, 1)
+            with mock.patch('bank.state.save', side_effect=OSError('disk full')):
+                failed = await add(app, 2)
+            retried = await add(app, 3)
+            await app.stop()
+            return saved, failed, retried
+
+        for backend in ('json', 'sqlite'):
+            with self.subTest(backend=backend):
+                self.setUp()
+                state.BACKEND, state.MODE = backend, 'journal'
+                drive.state_refresh()
+                saved, failed, retried = asyncio.run(_run())
+                self.assertEqual(1, saved['success'])
+                self.assertNotIn('persist_error', saved)
+                self.assertEqual(1, failed['success'])
+                self.assertIn('disk full', failed['persist_error'])
+                self.assertEqual(1, retried['success'])
+                ledger = state.load()
+                self.assertEqual(3, len(ledger.accounts['AC001'].transactions))
+                if backend != 'json':
+                    state.store().close()
+                state.BACKEND, state.MODE = 'json', 'snapshot'
+
+    def test_40_as_of_history_survives_restarts(self):
+        for backend, mode in (('json', 'snapshot'), ('json', 'journal'), ('sqlite', 'snapshot'), ('binary', 'snapshot')):
+            with self.subTest(backend=backend, mode=mode):
+                self.setUp()
+                state.BACKEND, state.MODE = backend, mode
+                drive.state_refresh()
+                drive.rule_add('20230101', 'R1', 2.0)
+                drive.transaction_add('20230601', 'AC001', 'D', 100)
+                drive.transaction_add('20230601', 'AC002', 'D', 100)
+                seq = drive.ledger.seq
+                shown = drive.statement('AC001', '202306')
+                moment = dt.datetime.now()
+                time.sleep(0.01)
+                drive.state_refresh()
+                self.assertEqual(seq, drive.ledger.seq)
+                drive.transaction_add('20230605', 'AC001', 'D', 50)
+                self.assertEqual(seq + 1, drive.ledger.seq)
+                drive.state_refresh()
+                drive.rule_add('20230610', 'R2', 4.0)
+                drive.state_refresh()
+                self.assertEqual(seq + 2, drive.ledger.seq)
+                self.assertNotEqual(shown, drive.statement('AC001', '202306'))
+                self.assertEqual(shown, drive.statement('AC001', '202306', as_of=seq))
+                self.assertEqual(shown, drive.statement('AC001', '202306', as_of=moment))
+                self.assertEqual(100.0, drive.balance_as_of('AC001', '20230605', as_of=seq)['balance'])
+                self.assertEqual(150.0, drive.balance_as_of('AC001', '20230605', as_of=seq + 1)['balance'])
+                self.assertEqual(1, drive.statement('AC002', '202306', as_of=seq)['success'])
+                if backend != 'json':
+                    state.store().close()
+                state.BACKEND, state.MODE = 'json', 'snapshot'
+
+    def test_41_rule_change_writes_no_dirty_date_per_account(self):
+        for backend in ('sqlite', 'shards', 'binary'):
+            with self.subTest(backend=backend):
+                self.setUp()
+                state.BACKEND = backend
+                drive.state_refresh()
+                drive.rule_add('20230101', 'R1', 2.0)
+                for i in range(50):
+                    drive.transaction_add('20230601', f'AC{i:03d}', 'D', 100)
+                drive.statement('AC000', '202308')
+                drive.state_refresh()
+                drive.rule_add('20230301', 'R9', 9.0)
+                drive.state_refresh()
+                reaccrual = state.store().load_reaccrual()
+                self.assertEqual(2, len(reaccrual['rule_changes']))
+                self.assertLess(len(reaccrual['dirty_from']) + len(reaccrual['rules_seen']), 10)
+                self.assertIn('| 20230831 |             | I    |    0.78 |', drive.statement('AC000', '202308')['statement'])
+                state.store().close()
+                state.BACKEND = 'json'
+
+
+    def test_42_parallel_statements_skip_interest_posted_meanwhile(self):
+        ledger = Ledger()
+        ledger.add_rule('20230101', 'R1', 2.0)
+        for i in range(4):
+            ledger.add_transaction('20230601', f'AC00{i}', 'D', 100)
+        expected = Ledger.from_dict(ledger.to_dict())
+        serial = {name: expected.statement(name, '202307') for name in expected.accounts}
+        real_executor = ledger_module.ProcessPoolExecutor
+
+        class RacingExecutor(real_executor):
+            def map(self, *args, **kwargs):
+                # another statement() posts the month-end interest before the merge
+                results = list(super().map(*args, **kwargs))
+                ledger.statement('AC001', '202307')
+                return results
+
+        with mock.patch.object(ledger_module, 'ProcessPoolExecutor', RacingExecutor):
+            self.assertEqual(serial, ledger.statements_for_month('202307', workers=2))
+        self.assertEqual(1, len(ledger.accounts['AC001'].transactions_on(dt.date(2023, 7, 31))))
+        self.assertEqual(expected.to_dict(), ledger.to_dict())
+
 
 if __name__ == '__main__':
     unittest.main()